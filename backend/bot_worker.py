@@ -0,0 +1,13 @@
+"""Discord bot worker for split deployments (BOT_MODE=api).
+
+Runs the bot, delivery workers, payment reconciler and conversation sink in
+one process, while any number of uvicorn workers serve the stateless API.
+
+    python bot_worker.py
+"""
+import asyncio
+
+from server import run_worker
+
+if __name__ == "__main__":
+    asyncio.run(run_worker())
@@ -1,16 +1,34 @@
-from fastapi import FastAPI, APIRouter, HTTPException, BackgroundTasks
+from fastapi import FastAPI, APIRouter, HTTPException, BackgroundTasks, Query, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 from typing import List, Optional, Dict, Any
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
+from bisect import bisect_left
+import heapq
+from collections import Counter, OrderedDict
 import asyncio
+import base64
+import codecs
+import csv
+import hashlib
+import hmac
+import io
 import json
+import math
+import random
+import re
+import signal
+import time
+import unicodedata
 
 # Discord and AI imports
 import discord
@@ -23,9 +41,77 @@ from emergentintegrations.payments.stripe.checkout import StripeCheckout, Checko
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Metrics, rendered in Prometheus text format at /api/metrics. Everything is
+# preallocated or created once per label set, and updates are plain
+# increments: no locks on the hot path.
+class LatencyHistogram:
+    """Fixed-bucket latency histogram (seconds), cumulative on export"""
+    
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+    
+    def observe(self, seconds: float):
+        self.counts[bisect_left(self.BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+    
+    def snapshot(self):
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.BUCKETS + (float("inf"),), self.counts):
+            cumulative += count
+            buckets["+Inf" if bound == float("inf") else str(bound)] = cumulative
+        return {"count": self.count, "sum": self.total, "buckets": buckets}
+
+# (metric name, sorted label items) -> LatencyHistogram
+histograms = {}
+counters = dict.fromkeys((
+    "ai_fallback_total",
+    "ai_intent_routed_total",
+    "ai_rate_limited_total",
+    "guild_config_cache_hits_total",
+    "guild_config_cache_misses_total",
+    "user_cache_hits_total",
+    "user_cache_misses_total",
+), 0)
+
+def observe(name: str, seconds: float, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    histogram = histograms.get(key)
+    if histogram is None:
+        histogram = histograms[key] = LatencyHistogram()
+    histogram.observe(seconds)
+
+class MongoLatencyListener(monitoring.CommandListener):
+    """Records every Mongo command's latency per collection"""
+    
+    def __init__(self):
+        self._pending = {}
+    
+    def started(self, event):
+        command = event.command
+        collection = command.get("collection") if event.command_name == "getMore" else command.get(event.command_name)
+        if isinstance(collection, str):
+            self._pending[(event.connection_id, event.request_id)] = collection
+    
+    def succeeded(self, event):
+        self._finish(event)
+    
+    def failed(self, event):
+        self._finish(event)
+    
+    def _finish(self, event):
+        collection = self._pending.pop((event.connection_id, event.request_id), None)
+        if collection:
+            observe("mongo_operation_seconds", event.duration_micros / 1e6, collection=collection, command=event.command_name)
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[MongoLatencyListener()])
 db = client[os.environ['DB_NAME']]
 
 # Create the main app without a prefix
@@ -40,15 +126,859 @@ intents.message_content = True
 intents.guilds = True
 intents.guild_messages = True
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+# Sharding: by default discord.py picks the recommended shard count and runs every
+# shard in this process. To spread shards over processes, give each one the total
+# DISCORD_SHARD_COUNT and its own DISCORD_SHARD_IDS (e.g. "0,1").
+shard_options = {}
+if os.environ.get('DISCORD_SHARD_COUNT'):
+    shard_options["shard_count"] = int(os.environ['DISCORD_SHARD_COUNT'])
+if os.environ.get('DISCORD_SHARD_IDS'):
+    if "shard_count" not in shard_options:
+        raise RuntimeError("DISCORD_SHARD_IDS requires DISCORD_SHARD_COUNT (the total number of shards across all processes)")
+    shard_options["shard_ids"] = [int(i) for i in os.environ['DISCORD_SHARD_IDS'].split(",") if i.strip()]
+    invalid = [i for i in shard_options["shard_ids"] if not 0 <= i < shard_options["shard_count"]]
+    if invalid:
+        raise RuntimeError(f"DISCORD_SHARD_IDS {invalid} out of range for DISCORD_SHARD_COUNT={shard_options['shard_count']}")
+
+bot = commands.AutoShardedBot(command_prefix='!', intents=intents, **shard_options)
 
 # Global variables for bot state
 bot_running = False
-ai_chat_sessions = {}
+
+# embedded: bot runs inside the API process (single uvicorn worker)
+# api: stateless API; the bot runs in bot_worker.py and is driven through Mongo
+BOT_MODE = os.environ.get('BOT_MODE', 'embedded')
+BOT_HEARTBEAT_INTERVAL = float(os.environ.get('BOT_HEARTBEAT_INTERVAL', '10'))
+BOT_COMMAND_POLL_INTERVAL = float(os.environ.get('BOT_COMMAND_POLL_INTERVAL', '1'))
+BOT_INSTANCE_ID = f"shards:{os.environ.get('DISCORD_SHARD_IDS', 'all')}"
+
+class LlmSessionStore:
+    """LRU store for chat sessions with idle expiry.
+
+    Entries are kept in last-use order, so idle sessions are always at the
+    front and eviction is O(1) per entry. Evicted sessions are rebuilt from
+    the conversations and conversation_memories collections the next time
+    the user talks to the bot.
+    """
+    
+    def __init__(self, max_entries: int, idle_ttl: float):
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self._sessions = OrderedDict()  # session_id -> (last_used, chat)
+    
+    def get(self, session_id: str):
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] > self.idle_ttl:
+            del self._sessions[session_id]
+            return None
+        self._sessions[session_id] = (time.monotonic(), entry[1])
+        self._sessions.move_to_end(session_id)
+        return entry[1]
+    
+    def put(self, session_id: str, chat):
+        self._sessions[session_id] = (time.monotonic(), chat)
+        self._sessions.move_to_end(session_id)
+        self.evict()
+    
+    def pop(self, session_id: str):
+        entry = self._sessions.pop(session_id, None)
+        return entry[1] if entry else None
+    
+    def evict(self):
+        """Drop idle sessions and trim the store to max_entries"""
+        now = time.monotonic()
+        while self._sessions:
+            session_id, (last_used, _) = next(iter(self._sessions.items()))
+            if now - last_used <= self.idle_ttl and len(self._sessions) <= self.max_entries:
+                break
+            self._sessions.popitem(last=False)
+    
+    def __contains__(self, session_id: str):
+        return self.get(session_id) is not None
+    
+    def __len__(self):
+        return len(self._sessions)
+
+AI_SESSION_MAX = int(os.environ.get('AI_SESSION_MAX', '500'))
+AI_SESSION_IDLE_TTL = float(os.environ.get('AI_SESSION_IDLE_TTL', '1800'))
+ai_chat_sessions = LlmSessionStore(AI_SESSION_MAX, AI_SESSION_IDLE_TTL)
+
+# Context window: the last AI_CONTEXT_WINDOW_TURNS turns are sent verbatim and
+# older ones are folded into a summary in the background. Each request is
+# trimmed to AI_CONTEXT_TOKEN_BUDGET tokens (estimated at ~4 characters each).
+AI_CONTEXT_WINDOW_TURNS = int(os.environ.get('AI_CONTEXT_WINDOW_TURNS', '6'))
+AI_CONTEXT_SUMMARY_BATCH = int(os.environ.get('AI_CONTEXT_SUMMARY_BATCH', '4'))
+AI_CONTEXT_TOKEN_BUDGET = int(os.environ.get('AI_CONTEXT_TOKEN_BUDGET', '3000'))
+AI_CONTEXT_SUMMARY_TOKENS = int(os.environ.get('AI_CONTEXT_SUMMARY_TOKENS', '300'))
+
+# Per-session AI work queues: session_id -> asyncio.Queue drained by one worker.
+# Messages that queued up during the previous turn are answered together; a
+# non-zero AI_COALESCE_WINDOW also waits that long for follow-ups (added latency).
+AI_COALESCE_WINDOW = float(os.environ.get('AI_COALESCE_WINDOW', '0'))
+AI_COALESCE_MAX_MESSAGES = int(os.environ.get('AI_COALESCE_MAX_MESSAGES', '5'))
+AI_SESSION_WORKER_IDLE = float(os.environ.get('AI_SESSION_WORKER_IDLE', '60'))
+AI_MAX_CONCURRENT_LLM = int(os.environ.get('AI_MAX_CONCURRENT_LLM', '8'))
+ai_session_queues = {}
+llm_semaphore = asyncio.Semaphore(AI_MAX_CONCURRENT_LLM)
+llm_in_flight = 0
+
+# Streaming replies. Discord allows 5 message edits per 5 s per channel, so
+# streamed edits in a channel are spaced AI_STREAM_EDIT_INTERVAL apart, shared
+# by every reply streaming there.
+DISCORD_MESSAGE_LIMIT = 2000
+AI_STREAM_REPLIES = os.environ.get('AI_STREAM_REPLIES', 'true').lower() == 'true'
+AI_STREAM_EDIT_INTERVAL = float(os.environ.get('AI_STREAM_EDIT_INTERVAL', '1.2'))
+AI_STREAM_PLACEHOLDER = "💭 Pensando..."
+stream_edit_slots = {}  # channel id -> monotonic time of the next free edit slot
+
+# Deterministic intents, matched on normalize_text() output before any LLM call.
+# All patterns are compiled into one alternation, so routing is a single scan.
+# Listing, help and greeting must be the whole message: "o catalogo tem spotify"
+# or "preciso de ajuda com meu pedido" are questions for the LLM.
+INTENT_PATTERNS = {
+    "list_products": r"^(?:(?:listar|mostrar|ver|liste|mostre|me mostre)(?: (?:os|todos os|a lista de))? produtos|(?:quais (?:sao )?(?:os )?)?produtos(?: disponiveis)?|(?:(?:ver|mostrar|mostre|me mostre) )?(?:o )?catalogo)$",
+    "add_product": r"\b(?:adicionar|cadastrar|criar|adicione|cadastre)(?: (?:um|o|novo|um novo))? produto\b",
+    "help": r"^(?:ajuda|help|comandos|quais (?:sao )?(?:os )?comandos|preciso de ajuda)$",
+    "greeting": r"^(?:oi+|ola|hello|hi|hey|eai|e ai|salve|bom dia|boa tarde|boa noite)(?: (?:bot|pessoal|galera|tudo bem|tudo bom))*$",
+}
+INTENT_ROUTER = re.compile("|".join(f"(?P<{name}>{pattern})" for name, pattern in INTENT_PATTERNS.items()))
+
+ADD_PRODUCT_INSTRUCTIONS = "Para adicionar o produto, preciso de mais algumas informações. Use o comando completo: `!adicionar_produto nome preço descrição categoria estoque`"
+INTENT_RESPONSES = {
+    "greeting": "Olá! 👋 Sou o assistente da loja. Pergunte o que quiser ou use `!produtos` para ver o catálogo.",
+    "help": """🤖 **Comandos Disponíveis:**
+        
+• `!produtos` - Lista todos os produtos
+• `!buscar [termos]` - Busca produtos
+• `!adicionar_produto [nome] [preço] [desc] [categoria] [estoque]` - Adiciona produto
+• `!config_canal_ai` - Configura este canal para IA
+
+**Exemplos:**
+• `!adicionar_produto Netflix 25.99 "Conta Premium" streaming 5`
+• `!produtos`""",
+}
+
+def normalize_text(text: str) -> str:
+    """Lowercase, strip accents and punctuation, collapse whitespace"""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(re.findall(r"[a-z0-9]+", text))
+
+class ResponseCache:
+    """TTL/LRU cache of AI answers keyed by scope and normalized question text.
+
+    Lookups try an exact match first. When similarity_threshold is set, they
+    fall back to the most similar cached question in the same scope by
+    TF-IDF cosine, scanning only entries that share a term with the query.
+    """
+    
+    def __init__(self, max_entries: int, ttl: float, similarity_threshold: float = 0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self._entries = OrderedDict()  # (scope, normalized question) -> (expires_at, response, term counts)
+        self._postings = {}  # term -> set of (scope, normalized question)
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+    
+    def get(self, question: str, scope: str = ""):
+        key = (scope, normalize_text(question))
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        if entry:
+            self._remove(key)
+        
+        if self.similarity_threshold > 0 and key[1]:
+            match = self._most_similar(key)
+            if match:
+                self.similar_hits += 1
+                return self._entries[match][1]
+        
+        self.misses += 1
+        return None
+    
+    def put(self, question: str, response: str, scope: str = ""):
+        key = (scope, normalize_text(question))
+        if not key[1]:
+            return
+        if key in self._entries:
+            self._remove(key)
+        terms = {}
+        for term in key[1].split():
+            terms[term] = terms.get(term, 0) + 1
+        self._entries[key] = (time.monotonic() + self.ttl, response, terms)
+        for term in terms:
+            self._postings.setdefault(term, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+    
+    def clear(self):
+        self._entries.clear()
+        self._postings.clear()
+    
+    def stats(self):
+        lookups = self.hits + self.similar_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "similar_hits": self.similar_hits,
+            "misses": self.misses,
+            "hit_ratio": (self.hits + self.similar_hits) / lookups if lookups else 0.0,
+        }
+    
+    def _remove(self, key: tuple):
+        entry = self._entries.pop(key, None)
+        if not entry:
+            return
+        for term in entry[2]:
+            keys = self._postings.get(term)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._postings[term]
+    
+    def _vector(self, terms: Dict[str, int]):
+        total = len(self._entries) + 1
+        vector = {
+            term: count * (math.log(total / (len(self._postings.get(term, ())) + 1)) + 1)
+            for term, count in terms.items()
+        }
+        norm = math.sqrt(sum(w * w for w in vector.values())) or 1.0
+        return {term: w / norm for term, w in vector.items()}
+    
+    def _most_similar(self, key: tuple):
+        scope, question = key
+        query_terms = {}
+        for term in question.split():
+            query_terms[term] = query_terms.get(term, 0) + 1
+        candidates = set()
+        for term in query_terms:
+            candidates |= {candidate for candidate in self._postings.get(term, ()) if candidate[0] == scope}
+        
+        query = self._vector(query_terms)
+        now = time.monotonic()
+        best, best_score = None, self.similarity_threshold
+        for candidate in candidates:
+            expires_at, _, terms = self._entries[candidate]
+            if expires_at <= now:
+                continue
+            vector = self._vector(terms)
+            score = sum(w * vector.get(term, 0.0) for term, w in query.items())
+            if score >= best_score:
+                best, best_score = candidate, score
+        return best
+
+AI_CACHE_MAX = int(os.environ.get('AI_CACHE_MAX', '1000'))
+AI_CACHE_TTL = float(os.environ.get('AI_CACHE_TTL', '3600'))
+AI_CACHE_MAX_QUESTION_LEN = int(os.environ.get('AI_CACHE_MAX_QUESTION_LEN', '200'))
+# 0 disables the similarity layer; ~0.85 works well for short questions
+AI_CACHE_SIMILARITY_THRESHOLD = float(os.environ.get('AI_CACHE_SIMILARITY_THRESHOLD', '0'))
+ai_response_cache = ResponseCache(AI_CACHE_MAX, AI_CACHE_TTL, AI_CACHE_SIMILARITY_THRESHOLD)
+
+class ConversationSink:
+    """Buffers conversation documents and writes them with insert_many.
+
+    A batch is flushed when it reaches batch_size or has waited
+    flush_interval seconds. The bounded queue gives backpressure: add()
+    waits when max_pending documents are already buffered. Failed writes
+    are retried with backoff; documents the server rejects are dropped.
+    """
+    
+    def __init__(self, collection, batch_size: int, flush_interval: float, max_pending: int):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        self._task = None
+    
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+    
+    async def add(self, document: dict):
+        await self.queue.put(document)
+    
+    async def close(self):
+        """Flush everything buffered and stop the writer"""
+        if self._task is None or self._task.done():
+            return
+        await self.queue.put(None)
+        await self._task
+    
+    async def _run(self):
+        while True:
+            first = await self.queue.get()
+            if first is None:
+                return
+            batch = [first]
+            stopping = False
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    document = await asyncio.wait_for(self.queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if document is None:
+                    stopping = True
+                    break
+                batch.append(document)
+            await self._write(batch)
+            if stopping:
+                # Drain whatever was queued behind the stop marker
+                while not self.queue.empty():
+                    leftover = [d for d in self._take(self.batch_size) if d is not None]
+                    if leftover:
+                        await self._write(leftover)
+                return
+    
+    def _take(self, count: int):
+        items = []
+        while len(items) < count and not self.queue.empty():
+            items.append(self.queue.get_nowait())
+        return items
+    
+    async def _write(self, batch):
+        for attempt in range(CONVERSATION_WRITE_RETRIES + 1):
+            try:
+                await self.collection.insert_many(batch, ordered=False)
+                break
+            except BulkWriteError as e:
+                # Unordered: everything but the reported documents was written.
+                # Duplicate keys are documents an earlier attempt already wrote.
+                errors = e.details.get("writeErrors", [])
+                failed = [error for error in errors if error.get("code") != 11000]
+                rejected = {error["index"] for error in failed}
+                if failed:
+                    print(f"Erro ao gravar {len(failed)} de {len(batch)} conversas: {failed[0].get('errmsg')}")
+                batch = [document for i, document in enumerate(batch) if i not in rejected]
+                break
+            except Exception as e:
+                if attempt == CONVERSATION_WRITE_RETRIES:
+                    print(f"Erro ao gravar {len(batch)} conversas, descartadas: {e}")
+                    return
+                delay = min(CONVERSATION_RETRY_BASE * 2 ** attempt, CONVERSATION_RETRY_MAX)
+                print(f"Erro ao gravar {len(batch)} conversas, nova tentativa em {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+        for document in batch:
+            event_hub.publish_local("conversation", document)
+
+CONVERSATION_BATCH_SIZE = int(os.environ.get('CONVERSATION_BATCH_SIZE', '100'))
+CONVERSATION_FLUSH_INTERVAL = float(os.environ.get('CONVERSATION_FLUSH_INTERVAL', '1.0'))
+CONVERSATION_MAX_PENDING = int(os.environ.get('CONVERSATION_MAX_PENDING', '10000'))
+CONVERSATION_WRITE_RETRIES = int(os.environ.get('CONVERSATION_WRITE_RETRIES', '5'))
+CONVERSATION_RETRY_BASE = float(os.environ.get('CONVERSATION_RETRY_BASE', '0.5'))
+CONVERSATION_RETRY_MAX = float(os.environ.get('CONVERSATION_RETRY_MAX', '10'))
+conversation_sink = ConversationSink(db.conversations, CONVERSATION_BATCH_SIZE, CONVERSATION_FLUSH_INTERVAL, CONVERSATION_MAX_PENDING)
+
+class EventHub:
+    """Fan-out of dashboard events to live subscribers.
+
+    While anyone is subscribed, a single database change stream feeds all of
+    them, so N dashboards cost one watch. On a standalone mongod (no change
+    streams) the in-process publish_local() calls are delivered instead.
+    Slow subscribers lose their oldest events rather than block the rest.
+    Events the dashboard answers with a full refetch are coalesced: a burst
+    of them is sent as one event, coalesce_interval seconds after the first.
+    """
+    
+    # collection -> event name
+    WATCHED = {"conversations": "conversation", "payment_transactions": "transaction", "products": "product"}
+    COALESCED = frozenset({"product"})
+    
+    def __init__(self, queue_size: int, coalesce_interval: float = 1.0):
+        self.queue_size = queue_size
+        self.coalesce_interval = coalesce_interval
+        self.subscribers = set()
+        self.watching = False
+        self._watch_task = None
+        self._pending = {}  # coalesced event -> scheduled flush
+    
+    def subscribe(self):
+        queue = asyncio.Queue(self.queue_size)
+        self.subscribers.add(queue)
+        if self._watch_task is None or self._watch_task.done():
+            self._watch_task = asyncio.create_task(self._watch())
+        return queue
+    
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+        if not self.subscribers and self._watch_task:
+            self._watch_task.cancel()
+            self._watch_task = None
+            self.watching = False
+    
+    def publish(self, event: str, data: dict):
+        if event in self.COALESCED:
+            if event not in self._pending:
+                self._pending[event] = asyncio.get_running_loop().call_later(self.coalesce_interval, self._flush, event)
+            return
+        self._deliver(event, data)
+    
+    def _flush(self, event: str):
+        del self._pending[event]
+        self._deliver(event, {})
+    
+    def _deliver(self, event: str, data: dict):
+        for queue in self.subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait((event, data))
+    
+    def publish_local(self, event: str, data: dict):
+        """Publish an in-process event unless the change stream already covers it"""
+        if not self.watching:
+            self.publish(event, data)
+    
+    async def _watch(self):
+        pipeline = [{"$match": {"ns.coll": {"$in": list(self.WATCHED)}}}]
+        try:
+            async with db.watch(pipeline, full_document="updateLookup") as stream:
+                self.watching = True
+                async for change in stream:
+                    event = self.WATCHED[change["ns"]["coll"]]
+                    self.publish(event, change.get("fullDocument") or {})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Change stream indisponível para o painel, usando eventos locais: {e}")
+        finally:
+            self.watching = False
+
+SSE_QUEUE_SIZE = int(os.environ.get('SSE_QUEUE_SIZE', '500'))
+SSE_HEARTBEAT = float(os.environ.get('SSE_HEARTBEAT', '15'))
+SSE_COALESCE_INTERVAL = float(os.environ.get('SSE_COALESCE_INTERVAL', '1'))
+event_hub = EventHub(SSE_QUEUE_SIZE, SSE_COALESCE_INTERVAL)
+
+# Product listing embeds (Discord allows 25 fields / 6000 chars per embed)
+PRODUCTS_PER_EMBED = min(int(os.environ.get('PRODUCTS_PER_EMBED', '10')), 25)
+EMBED_FIELD_NAME_LIMIT = 256
+EMBED_FIELD_VALUE_LIMIT = 1024
+EMBED_TOTAL_LIMIT = 5500  # headroom under 6000 for title and footer
+CATALOG_SNAPSHOT_TTL = float(os.environ.get('CATALOG_SNAPSHOT_TTL', '300'))
+
+# Bulk product import/export: rows are validated and written PRODUCT_IMPORT_BATCH
+# at a time, and at most PRODUCT_IMPORT_MAX_ERRORS row errors are reported back
+PRODUCT_IMPORT_BATCH = int(os.environ.get('PRODUCT_IMPORT_BATCH', '500'))
+PRODUCT_IMPORT_MAX_ERRORS = int(os.environ.get('PRODUCT_IMPORT_MAX_ERRORS', '1000'))
+# A record larger than this (characters, or CSV lines for quoted line breaks)
+# is reported as failed, so a stray quote can't swallow the rest of the file
+PRODUCT_IMPORT_MAX_RECORD_SIZE = int(os.environ.get('PRODUCT_IMPORT_MAX_RECORD_SIZE', '65536'))
+PRODUCT_IMPORT_MAX_RECORD_LINES = int(os.environ.get('PRODUCT_IMPORT_MAX_RECORD_LINES', '50'))
+PRODUCT_EXPORT_FIELDS = ["sku", "id", "name", "price", "description", "category", "stock", "active", "created_at"]
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+# Catalog grounding: the AI_CATALOG_TOP_K products most relevant to a question
+# are added to its prompt, within AI_CATALOG_TOKEN_BUDGET tokens
+AI_CATALOG_TOP_K = int(os.environ.get('AI_CATALOG_TOP_K', '5'))
+AI_CATALOG_TOKEN_BUDGET = int(os.environ.get('AI_CATALOG_TOKEN_BUDGET', '500'))
+SEARCH_STOPWORDS = frozenset("""a o as os um uma uns umas de da do das dos e em no na nos nas para pra por
+com sem que qual quais quanto quanta me eu voce voces tem ter ha se ao aos the of and for""".split())
+SEARCH_MAX_PREFIX_TERMS = int(os.environ.get('SEARCH_MAX_PREFIX_TERMS', '200'))
+
+# Stripe webhook events we act on -> payment_status they imply (None: read it from the session)
+STRIPE_CHECKOUT_EVENTS = {
+    "checkout.session.completed": None,
+    "checkout.session.async_payment_succeeded": "paid",
+    "checkout.session.async_payment_failed": "failed",
+    "checkout.session.expired": None,
+}
+STRIPE_WEBHOOK_TOLERANCE = 300
+STRIPE_EVENT_RETENTION = int(os.environ.get('STRIPE_EVENT_RETENTION', str(30 * 24 * 3600)))
+PAYMENT_RECONCILE_INTERVAL = float(os.environ.get('PAYMENT_RECONCILE_INTERVAL', '60'))
+PAYMENT_RECONCILE_MIN_AGE = float(os.environ.get('PAYMENT_RECONCILE_MIN_AGE', '30'))
+PAYMENT_RECONCILE_BATCH = int(os.environ.get('PAYMENT_RECONCILE_BATCH', '50'))
+STRIPE_SESSION_TTL = int(os.environ.get('STRIPE_SESSION_TTL', str(24 * 3600)))  # Stripe's default expiry
+RESERVATION_GRACE = int(os.environ.get('RESERVATION_GRACE', '3600'))
+
+# Delivery job queue (delivery_jobs collection)
+DELIVERY_WORKERS = int(os.environ.get('DELIVERY_WORKERS', '4'))
+DELIVERY_MAX_ATTEMPTS = int(os.environ.get('DELIVERY_MAX_ATTEMPTS', '8'))
+DELIVERY_RETRY_BASE = float(os.environ.get('DELIVERY_RETRY_BASE', '5'))
+DELIVERY_RETRY_MAX = float(os.environ.get('DELIVERY_RETRY_MAX', '900'))
+DELIVERY_LEASE = float(os.environ.get('DELIVERY_LEASE', '120'))
+DELIVERY_POLL_INTERVAL = float(os.environ.get('DELIVERY_POLL_INTERVAL', '5'))
+DELIVERY_CLAIM_BATCH = int(os.environ.get('DELIVERY_CLAIM_BATCH', '20'))
+delivery_wakeup = asyncio.Event()
+
+# Users fetched over REST: user_id -> (expires_at, user or None if it doesn't exist)
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', '600'))
+USER_CACHE_MAX = int(os.environ.get('USER_CACHE_MAX', '5000'))
+USER_FETCH_CONCURRENCY = int(os.environ.get('USER_FETCH_CONCURRENCY', '5'))
+fetched_users = OrderedDict()
+
+class PaymentsUnavailable(Exception):
+    """Raised while the payments circuit breaker is open"""
+
+class PaymentsClient:
+    """Shared StripeCheckout client with timeouts, retries and a circuit breaker.
+
+    One StripeCheckout lives for the whole app instead of one per request.
+    Status lookups are retried with jittered exponential backoff; session
+    creation is not, since a retried create could open a second session.
+    After breaker_threshold consecutive failures, calls fail fast with
+    PaymentsUnavailable for breaker_cooldown seconds, then one trial call is
+    let through.
+    """
+    
+    def __init__(self, timeout: float, retries: int, breaker_threshold: int, breaker_cooldown: float):
+        self.timeout = timeout
+        self.retries = retries
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.latency = {"create_checkout_session": LatencyHistogram(), "get_checkout_status": LatencyHistogram()}
+        self._checkout = None
+        self._trial_running = False
+    
+    @property
+    def checkout(self):
+        if self._checkout is None:
+            self._checkout = StripeCheckout(api_key=os.environ.get('STRIPE_API_KEY'))
+        return self._checkout
+    
+    async def close(self):
+        close = getattr(self._checkout, "close", None)
+        if close:
+            result = close()
+            if asyncio.iscoroutine(result):
+                await result
+        self._checkout = None
+    
+    async def create_checkout_session(self, checkout_request):
+        return await self._call("create_checkout_session", checkout_request, retries=0)
+    
+    async def get_checkout_status(self, session_id: str):
+        return await self._call("get_checkout_status", session_id, retries=self.retries)
+    
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.breaker_cooldown:
+            return "open"
+        return "half-open"
+    
+    def stats(self):
+        return {
+            "breaker": self.state(),
+            "consecutive_failures": self.failures,
+            "latency": {name: hist.snapshot() for name, hist in self.latency.items()},
+        }
+    
+    async def _call(self, method: str, argument, retries: int):
+        state = self.state()
+        if state == "open" or (state == "half-open" and self._trial_running):
+            raise PaymentsUnavailable("Provedor de pagamentos indisponível")
+        if state == "half-open":
+            self._trial_running = True
+            retries = 0
+        try:
+            return await self._attempt(method, argument, retries)
+        finally:
+            if state == "half-open":
+                self._trial_running = False
+    
+    async def _attempt(self, method: str, argument, retries: int):
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                result = await asyncio.wait_for(getattr(self.checkout, method)(argument), self.timeout)
+            except Exception as e:
+                self.latency[method].observe(time.monotonic() - started)
+                if not is_transient_error(e):
+                    raise
+                self._record_failure()
+                if attempt >= retries or self.state() == "open":
+                    raise
+                attempt += 1
+                await asyncio.sleep(min(PAYMENTS_RETRY_BASE * 2 ** attempt, 5.0) * random.uniform(0.5, 1.5))
+                continue
+            self.latency[method].observe(time.monotonic() - started)
+            self.failures = 0
+            self.opened_at = None
+            return result
+    
+    def _record_failure(self):
+        self.failures += 1
+        if self.failures >= self.breaker_threshold or self.opened_at is not None:
+            # Trip (or re-trip after a failed half-open trial)
+            self.opened_at = time.monotonic()
+
+def is_transient_error(error: Exception) -> bool:
+    """Timeouts, connection problems and provider rate limits / 5xx are worth retrying"""
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    name = type(error).__name__
+    if name in ("APIConnectionError", "RateLimitError", "APIError", "ServiceUnavailableError"):
+        return True
+    status = getattr(error, "http_status", None) or getattr(error, "status_code", None)
+    return isinstance(status, int) and (status == 429 or status >= 500)
+
+PAYMENTS_TIMEOUT = float(os.environ.get('PAYMENTS_TIMEOUT', '10'))
+PAYMENTS_RETRIES = int(os.environ.get('PAYMENTS_RETRIES', '2'))
+PAYMENTS_RETRY_BASE = float(os.environ.get('PAYMENTS_RETRY_BASE', '0.2'))
+PAYMENTS_BREAKER_THRESHOLD = int(os.environ.get('PAYMENTS_BREAKER_THRESHOLD', '5'))
+PAYMENTS_BREAKER_COOLDOWN = float(os.environ.get('PAYMENTS_BREAKER_COOLDOWN', '30'))
+payments_client = PaymentsClient(PAYMENTS_TIMEOUT, PAYMENTS_RETRIES, PAYMENTS_BREAKER_THRESHOLD, PAYMENTS_BREAKER_COOLDOWN)
+
+AI_SYSTEM_MESSAGE = """Você é um assistente inteligente para um servidor Discord com sistema de loja.
+                    
+                    Você pode ajudar com:
+                    - Adicionar produtos: "adicionar produto [nome] com preço [valor]"
+                    - Listar produtos: "mostrar produtos" ou "listar produtos"
+                    - Remover produtos: "remover produto [nome]"
+                    - Configurar loja: "configurar loja"
+                    - Responder perguntas gerais
+                    
+                    Sempre responda em português de forma amigável e útil. Quando um usuário quiser adicionar um produto, 
+                    você deve fazer perguntas para coletar todos os detalhes necessários como nome, preço, descrição, categoria e estoque.
+                    
+                    Responda sempre de forma clara e direta."""
+
+AI_SUMMARY_SYSTEM_MESSAGE = f"""Você resume conversas entre um usuário e o assistente de uma loja no Discord.
+Escreva em português, em no máximo {AI_CONTEXT_SUMMARY_TOKENS * 3 // 4} palavras, só o que for útil para continuar a conversa:
+o que o usuário quer, produtos e preços mencionados, decisões tomadas e pendências."""
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+def truncate_to_tokens(text: str, tokens: int) -> str:
+    return text[:tokens * 4]
+
+def new_llm_chat(session_id: str, system_message: str, history: List[dict]):
+    """Build an LlmChat seeded with history"""
+    chat_kwargs = {
+        "api_key": os.environ.get('OPENAI_API_KEY'),
+        "session_id": session_id,
+        "system_message": system_message,
+    }
+    if history:
+        try:
+            chat = LlmChat(initial_messages=history, **chat_kwargs)
+        except TypeError:
+            # Older emergentintegrations releases don't accept seeded history
+            transcript = "\n".join(f"{turn['role']}: {turn['content']}" for turn in history)
+            chat_kwargs["system_message"] = f"{system_message}\n\nMensagens recentes:\n{transcript}"
+            chat = LlmChat(**chat_kwargs)
+    else:
+        chat = LlmChat(**chat_kwargs)
+    return chat.with_model("openai", "gpt-4o")
+
+class ChatContext:
+    """Bounded LLM context for one session.
+
+    Every request gets a fresh LlmChat holding the summary memory plus the
+    most recent turns that fit the token budget, so request size no longer
+    grows with the conversation. Once AI_CONTEXT_SUMMARY_BATCH turns have
+    left the window, a background task folds them into the summary.
+    """
+    
+    def __init__(self, session_id: str, turns=None, summary: str = ""):
+        self.session_id = session_id
+        self.turns = list(turns or [])  # [(user message, assistant response)], oldest first
+        self.summary = summary
+        self._summarizing = None
+    
+    def prepare(self, content: str, catalog: str = ""):
+        """Return (chat, content) for one request, within the token budget"""
+        system_message = AI_SYSTEM_MESSAGE
+        if catalog:
+            system_message += f"\n\n{catalog}"
+        if self.summary:
+            system_message += f"\n\nResumo da conversa até agora:\n{self.summary}"
+        content = truncate_to_tokens(content, AI_CONTEXT_TOKEN_BUDGET // 2)
+        budget = AI_CONTEXT_TOKEN_BUDGET - estimate_tokens(system_message) - estimate_tokens(content)
+        
+        # Newest turns first, stopping at the first one that doesn't fit
+        history = []
+        for user_text, assistant_text in reversed(self.turns[-AI_CONTEXT_WINDOW_TURNS:]):
+            budget -= estimate_tokens(user_text) + estimate_tokens(assistant_text)
+            if budget < 0:
+                break
+            history[:0] = [{"role": "user", "content": user_text}, {"role": "assistant", "content": assistant_text}]
+        return new_llm_chat(self.session_id, system_message, history), content
+    
+    def record(self, content: str, response: str):
+        self.turns.append((content, response))
+        if self._summarizing is not None:
+            return
+        aged = len(self.turns) - AI_CONTEXT_WINDOW_TURNS
+        # Summaries keep failing: forget the oldest turns rather than grow
+        overflow = aged - 4 * AI_CONTEXT_SUMMARY_BATCH
+        if overflow > 0:
+            del self.turns[:overflow]
+            aged -= overflow
+        if aged >= AI_CONTEXT_SUMMARY_BATCH:
+            self._summarizing = asyncio.create_task(self.summarize(self.turns[:aged]))
+    
+    async def summarize(self, turns):
+        """Fold turns (the oldest ones) into the summary and persist it"""
+        global llm_in_flight
+        try:
+            transcript = "\n".join(f"Usuário: {user_text}\nAssistente: {assistant_text}" for user_text, assistant_text in turns)
+            prompt = truncate_to_tokens(
+                f"Resumo anterior:\n{self.summary or '(nenhum)'}\n\nNovas mensagens:\n{transcript}\n\nEscreva o resumo atualizado.",
+                AI_CONTEXT_TOKEN_BUDGET
+            )
+            chat = new_llm_chat(f"{self.session_id}:memory", AI_SUMMARY_SYSTEM_MESSAGE, [])
+            async with llm_semaphore:
+                llm_in_flight += 1
+                started = time.perf_counter()
+                try:
+                    summary = await chat.send_message(UserMessage(text=prompt))
+                finally:
+                    llm_in_flight -= 1
+                    observe("llm_summary_seconds", time.perf_counter() - started)
+            
+            self.summary = truncate_to_tokens(summary.strip(), AI_CONTEXT_SUMMARY_TOKENS)
+            if self.turns[:len(turns)] == turns:
+                del self.turns[:len(turns)]
+            await db.conversation_memories.update_one(
+                {"session_id": self.session_id},
+                {"$set": {"summary": self.summary, "updated_at": datetime.utcnow()}},
+                upsert=True
+            )
+        except Exception as e:
+            print(f"Erro ao resumir a sessão {self.session_id}: {e}")
+        finally:
+            self._summarizing = None
+
+# Guild config cache: guild_id -> (expires_at, config). Misses are cached too,
+# so messages in unconfigured guilds don't hit Mongo either.
+GUILD_CONFIG_CACHE_TTL = float(os.environ.get('GUILD_CONFIG_CACHE_TTL', '300'))
+GUILD_CONFIG_CACHE_MAX = int(os.environ.get('GUILD_CONFIG_CACHE_MAX', '1000'))
+GUILD_CONFIG_POLL_INTERVAL = float(os.environ.get('GUILD_CONFIG_POLL_INTERVAL', '30'))
+guild_config_cache = OrderedDict()
+
+# Cross-process invalidation (split mode runs a bot worker and API_WORKERS API
+# processes): writes bump a counter in the cache_versions collection, and every
+# process polls the counters and drops its copy when another process moved one.
+CACHE_VERSION_POLL_INTERVAL = float(os.environ.get('CACHE_VERSION_POLL_INTERVAL', '2'))
+seen_cache_versions = {}  # counter name -> last version this process has applied
+
+# Admission control for AI channel messages: token buckets per user, channel and
+# guild, checked before any DB or LLM work. Rates are messages per minute; a
+# guild's bot config can override them (<scope>_rate_limit / <scope>_rate_burst,
+# 0 disables that scope). RATE_LIMIT_BACKEND=mongo shares the buckets between
+# processes (e.g. one bot worker per shard group) at the cost of a round trip.
+RATE_LIMIT_DEFAULTS = {
+    "user": (float(os.environ.get('RATE_LIMIT_USER_PER_MINUTE', '6')), int(os.environ.get('RATE_LIMIT_USER_BURST', '3'))),
+    "channel": (float(os.environ.get('RATE_LIMIT_CHANNEL_PER_MINUTE', '30')), int(os.environ.get('RATE_LIMIT_CHANNEL_BURST', '10'))),
+    "guild": (float(os.environ.get('RATE_LIMIT_GUILD_PER_MINUTE', '120')), int(os.environ.get('RATE_LIMIT_GUILD_BURST', '30'))),
+}
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')  # memory | mongo
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', '10000'))
+RATE_LIMIT_NOTICE_INTERVAL = float(os.environ.get('RATE_LIMIT_NOTICE_INTERVAL', '30'))
+RATE_LIMIT_NOTICE_TTL = float(os.environ.get('RATE_LIMIT_NOTICE_TTL', '10'))
+RATE_LIMIT_NOTICES = {
+    "user": "⏳ Você está enviando mensagens rápido demais. Aguarde um pouco antes de perguntar de novo.",
+    "channel": "⏳ Este canal está recebendo muitas mensagens. Aguarde um pouco antes de perguntar de novo.",
+    "guild": "⏳ O assistente está sobrecarregado neste servidor. Tente novamente em instantes.",
+}
+
+class TokenBucketLimiter:
+    """Token buckets keyed by scope, in process memory or shared through Mongo.
+
+    acquire() charges a message to several buckets at once: it takes one token
+    from each of them, or none if any bucket is empty, and returns the scope
+    that rejected the message. Rejection notices are throttled per key.
+    """
+    
+    def __init__(self, backend: str, max_keys: int, notice_interval: float):
+        self.backend = backend
+        self.max_keys = max_keys
+        self.notice_interval = notice_interval
+        self.buckets = OrderedDict()  # key -> [tokens, monotonic time of last refill]
+        self.notified = OrderedDict()  # key -> monotonic time of last notice
+    
+    async def acquire(self, limits) -> Optional[str]:
+        """limits: [(scope, key, per_minute, burst)]; returns the rejecting scope"""
+        limits = [limit for limit in limits if limit[2] > 0 and limit[3] > 0]
+        if self.backend != "mongo":
+            return self._acquire_local(limits)
+        try:
+            return await self._acquire_shared(limits)
+        except Exception as e:
+            # Fail open: a Mongo hiccup should not silence the bot
+            print(f"Erro no rate limit compartilhado: {e}")
+            return None
+    
+    def _acquire_local(self, limits) -> Optional[str]:
+        now = time.monotonic()
+        charged = []
+        for scope, key, per_minute, burst in limits:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [float(burst), now]
+            else:
+                self.buckets.move_to_end(key)
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * per_minute / 60)
+            bucket[1] = now
+            if bucket[0] < 1:
+                return scope
+            charged.append(bucket)
+        
+        for bucket in charged:
+            bucket[0] -= 1
+        while len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+        return None
+    
+    async def _acquire_shared(self, limits) -> Optional[str]:
+        charged = []
+        for scope, key, per_minute, burst in limits:
+            if not await self._take_shared(key, per_minute, burst):
+                if charged:
+                    # Give back the tokens already taken; the next refill clamps to burst
+                    await db.rate_limits.update_many({"_id": {"$in": charged}}, {"$inc": {"tokens": 1}})
+                return scope
+            charged.append(key)
+        return None
+    
+    async def _take_shared(self, key: str, per_minute: float, burst: int) -> bool:
+        now = datetime.utcnow()
+        elapsed = {"$divide": [{"$subtract": [now, {"$ifNull": ["$updated_at", now]}]}, 1000]}
+        refilled = {"$min": [burst, {"$add": [{"$ifNull": ["$tokens", burst]}, {"$multiply": [elapsed, per_minute / 60]}]}]}
+        bucket = await db.rate_limits.find_one_and_update(
+            {"_id": key},
+            [
+                # A full bucket is the same as no bucket, so idle ones expire
+                {"$set": {"tokens": refilled, "updated_at": now, "expires_at": now + timedelta(seconds=burst * 60 / per_minute)}},
+                {"$set": {"allowed": {"$gte": ["$tokens", 1]}}},
+                {"$set": {"tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", 1]}, "$tokens"]}}},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return bucket["allowed"]
+    
+    def should_notify(self, key: str) -> bool:
+        now = time.monotonic()
+        last = self.notified.get(key)
+        if last is not None and now - last < self.notice_interval:
+            return False
+        self.notified[key] = now
+        self.notified.move_to_end(key)
+        while len(self.notified) > self.max_keys:
+            self.notified.popitem(last=False)
+        return True
+
+rate_limiter = TokenBucketLimiter(RATE_LIMIT_BACKEND, RATE_LIMIT_MAX_KEYS, RATE_LIMIT_NOTICE_INTERVAL)
 
 # Pydantic Models
 class Product(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    sku: Optional[str] = None
     name: str
     price: float
     description: Optional[str] = ""
@@ -58,6 +988,7 @@ class Product(BaseModel):
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
 class ProductCreate(BaseModel):
+    sku: Optional[str] = None
     name: str
     price: float
     description: Optional[str] = ""
@@ -72,6 +1003,13 @@ class BotConfig(BaseModel):
     welcome_message: Optional[str] = "Bem-vindo ao servidor!"
     ai_enabled: bool = True
     shop_enabled: bool = True
+    # Messages per minute and burst for the AI channel; None uses the server default
+    user_rate_limit: Optional[float] = None
+    user_rate_burst: Optional[int] = None
+    channel_rate_limit: Optional[float] = None
+    channel_rate_burst: Optional[int] = None
+    guild_rate_limit: Optional[float] = None
+    guild_rate_burst: Optional[int] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
 class Conversation(BaseModel):
@@ -96,13 +1034,15 @@ class PaymentTransaction(BaseModel):
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
     delivered: bool = False
+    reservation: Dict[str, Any] = {}  # quantity, status (held, committed, released), expires_at
 
 class Purchase(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     product_id: str
     discord_user_id: str
     origin_url: str
-    quantity: int = 1
+    quantity: int = Field(1, ge=1)
+    guild_id: Optional[str] = None  # guild the purchase came from, for delivery fallback
     
 class StatusCheck(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -118,12 +1058,29 @@ async def on_ready():
     global bot_running
     bot_running = True
     print(f'Bot conectado como {bot.user}')
+    event_hub.publish("bot", local_bot_status())
     
     # Initialize AI for configured guild
     guild_id = os.environ.get('DISCORD_GUILD_ID')
     if guild_id:
         await setup_guild_ai(guild_id)
 
+@bot.event
+async def on_shard_ready(shard_id: int):
+    """Warm the config cache for this shard's guilds in one query"""
+    guild_ids = [str(guild.id) for guild in bot.guilds if guild.shard_id == shard_id]
+    if not guild_ids:
+        return
+    try:
+        configs = await db.bot_configs.find({"guild_id": {"$in": guild_ids}}).to_list(len(guild_ids))
+    except Exception as e:
+        print(f"Erro ao pré-carregar configs do shard {shard_id}: {e}")
+        return
+    found = {config["guild_id"]: config for config in configs}
+    for guild_id in guild_ids:
+        cache_guild_config(guild_id, found.get(guild_id))
+    print(f"Shard {shard_id} pronto com {len(guild_ids)} servidores")
+
 @bot.event
 async def on_message(message):
     if message.author == bot.user:
@@ -134,90 +1091,398 @@ async def on_message(message):
     if not config or not config.get('ai_enabled', False):
         return
     
+    # Commands are answered by their handlers only, and never throttled
     ai_channel_id = config.get('ai_channel_id')
-    if ai_channel_id and str(message.channel.id) == ai_channel_id:
-        await process_ai_message(message)
+    is_command = message.content.startswith(bot.command_prefix)
+    if ai_channel_id and str(message.channel.id) == ai_channel_id and not is_command:
+        rejected = await rate_limiter.acquire(rate_limits_for(message, config))
+        if rejected:
+            counters["ai_rate_limited_total"] += 1
+            await notify_rate_limited(message, rejected)
+        else:
+            await process_ai_message(message)
     
     await bot.process_commands(message)
 
+def rate_limits_for(message, config: dict):
+    """Buckets an AI channel message is charged to, with the guild's overrides"""
+    guild_id = message.guild.id
+    keys = {
+        "user": f"user:{guild_id}:{message.author.id}",
+        "channel": f"channel:{message.channel.id}",
+        "guild": f"guild:{guild_id}",
+    }
+    limits = []
+    for scope, key in keys.items():
+        per_minute, burst = RATE_LIMIT_DEFAULTS[scope]
+        if config.get(f"{scope}_rate_limit") is not None:
+            per_minute = float(config[f"{scope}_rate_limit"])
+        if config.get(f"{scope}_rate_burst") is not None:
+            burst = int(config[f"{scope}_rate_burst"])
+        limits.append((scope, key, per_minute, burst))
+    return limits
+
+async def notify_rate_limited(message, scope: str):
+    """Tell the user they were throttled, at most once per notice interval"""
+    if not rate_limiter.should_notify(f"{message.author.id}:{message.channel.id}"):
+        return
+    try:
+        await message.channel.send(
+            f"{message.author.mention} {RATE_LIMIT_NOTICES[scope]}",
+            delete_after=RATE_LIMIT_NOTICE_TTL
+        )
+    except Exception as e:
+        print(f"Erro ao enviar aviso de rate limit: {e}")
+
 async def process_ai_message(message):
-    """Process message with AI and respond"""
+    """Queue message for its session's AI worker"""
+    session_id = f"{message.author.id}_{message.channel.id}"
+    
+    queue = ai_session_queues.get(session_id)
+    if queue is None:
+        queue = asyncio.Queue()
+        ai_session_queues[session_id] = queue
+        asyncio.create_task(ai_session_worker(session_id, queue))
+    await queue.put(message)
+
+async def ai_session_worker(session_id: str, queue: asyncio.Queue):
+    """Answer a session's messages one turn at a time.
+
+    Messages that arrived while the previous turn was running are merged
+    into a single LLM turn, so a lone message is answered right away. The
+    worker exits after AI_SESSION_WORKER_IDLE seconds without messages.
+    """
+    try:
+        await drain_session_queue(queue)
+    finally:
+        # Whatever ends the worker, the next message must start a new one
+        if ai_session_queues.get(session_id) is queue:
+            del ai_session_queues[session_id]
+
+async def drain_session_queue(queue: asyncio.Queue):
+    while True:
+        try:
+            first = await asyncio.wait_for(queue.get(), AI_SESSION_WORKER_IDLE)
+        except asyncio.TimeoutError:
+            if queue.empty():
+                return
+            continue
+        
+        batch = [first]
+        deadline = time.monotonic() + AI_COALESCE_WINDOW
+        while len(batch) < AI_COALESCE_MAX_MESSAGES:
+            if not queue.empty():
+                batch.append(queue.get_nowait())
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        
+        try:
+            await handle_ai_turn(batch)
+        except Exception as e:
+            print(f"Erro no turno de IA: {e}")
+
+async def handle_ai_turn(messages):
+    """Process a batch of messages from one session with AI and respond"""
+    message = messages[-1]
+    content = "\n".join(m.content for m in messages)
+    reply = None
     try:
         user_id = str(message.author.id)
         channel_id = str(message.channel.id)
         session_id = f"{user_id}_{channel_id}"
         
-        # Check if AI is available (has credits)
-        try:
-            # Get or create AI chat session
-            if session_id not in ai_chat_sessions:
-                ai_chat_sessions[session_id] = LlmChat(
-                    api_key=os.environ.get('OPENAI_API_KEY'),
-                    session_id=session_id,
-                    system_message="""Você é um assistente inteligente para um servidor Discord com sistema de loja.
-                    
-                    Você pode ajudar com:
-                    - Adicionar produtos: "adicionar produto [nome] com preço [valor]"
-                    - Listar produtos: "mostrar produtos" ou "listar produtos"
-                    - Remover produtos: "remover produto [nome]"
-                    - Configurar loja: "configurar loja"
-                    - Responder perguntas gerais
-                    
-                    Sempre responda em português de forma amigável e útil. Quando um usuário quiser adicionar um produto, 
-                    você deve fazer perguntas para coletar todos os detalhes necessários como nome, preço, descrição, categoria e estoque.
-                    
-                    Responda sempre de forma clara e direta."""
-                ).with_model("openai", "gpt-4o")
-            
-            # Send message to AI
-            user_message = UserMessage(text=message.content)
-            ai_response = await ai_chat_sessions[session_id].send_message(user_message)
-            
-        except Exception as ai_error:
-            # If AI fails (no credits, API issues), provide helpful fallback
-            print(f"AI Error: {ai_error}")
-            ai_response = await handle_message_without_ai(message.content)
-        
-        # Check if AI wants to perform an action
-        if "adicionar produto" in message.content.lower():
-            await handle_product_creation(message, ai_response)
-        elif "listar produtos" in message.content.lower() or "mostrar produtos" in message.content.lower():
-            await handle_product_listing(message)
+        # Deterministic intents are answered without calling the LLM. Each
+        # coalesced message is routed on its own, so a command sent next to a
+        # question doesn't swallow it; the rest goes to the LLM together.
+        # A greeting next to a question is left to the LLM's answer.
+        routed = [(queued, classify_intent(queued.content)) for queued in messages]
+        questions = [queued for queued, intent in routed if intent is None]
+        handled = set()
+        for queued, intent in routed:
+            if intent is None or intent in handled or intent == "greeting" and questions:
+                continue
+            handled.add(intent)
+            counters["ai_intent_routed_total"] += 1
+            ai_response = await handle_intent(intent, queued)
+            await conversation_sink.add(Conversation(
+                user_id=user_id,
+                channel_id=channel_id,
+                message=queued.content,
+                ai_response=ai_response,
+                session_id=session_id
+            ).dict())
+        if not questions:
+            return
+        message = questions[-1]
+        content = "\n".join(queued.content for queued, intent in routed if intent in (None, "greeting"))
+        
+        # Short opening questions may already have a cached answer. Only turns
+        # without history are cached: a follow-up's answer depends on the
+        # conversation and may quote the other user's details.
+        context = await get_chat_context(session_id)
+        cache_scope = str(message.guild.id) if message.guild else "dm"
+        cacheable = len(content) <= AI_CACHE_MAX_QUESTION_LEN and not context.turns and not context.summary
+        cached_response = ai_response_cache.get(content, cache_scope) if cacheable else None
+        
+        # Free-form answers are streamed into a placeholder that is edited as tokens arrive
+        if AI_STREAM_REPLIES and cached_response is None:
+            reply = StreamedReply(message.channel)
+            await reply.start()
+        
+        if cached_response is not None:
+            ai_response = cached_response
+            context.record(content, ai_response)
+        else:
+            # Check if AI is available (has credits)
+            try:
+                ai_response = await ask_llm(session_id, content, reply)
+                if cacheable:
+                    ai_response_cache.put(content, ai_response, cache_scope)
+            except Exception as ai_error:
+                # If AI fails (no credits, API issues), provide helpful fallback
+                print(f"AI Error: {ai_error}")
+                ai_response = await handle_message_without_ai(content)
+        
+        if reply:
+            await reply.finish(ai_response)
         else:
             # Send AI response
-            await message.channel.send(ai_response)
+            await send_long_message(message.channel, ai_response)
         
         # Store conversation
         conversation = Conversation(
             user_id=user_id,
             channel_id=channel_id,
-            message=message.content,
+            message=content,
             ai_response=ai_response,
             session_id=session_id
         )
-        await db.conversations.insert_one(conversation.dict())
+        await conversation_sink.add(conversation.dict())
         
     except Exception as e:
         print(f"Erro ao processar mensagem AI: {e}")
-        await message.channel.send("Desculpe, ocorreu um erro ao processar sua mensagem. Tente novamente ou use os comandos `!produtos` para ver produtos ou `!adicionar_produto` para adicionar produtos.")
+        if reply:
+            reply.abort()
+        try:
+            await message.channel.send("Desculpe, ocorreu um erro ao processar sua mensagem. Tente novamente ou use os comandos `!produtos` para ver produtos ou `!adicionar_produto` para adicionar produtos.")
+        except Exception as send_error:
+            print(f"Erro ao enviar aviso de falha: {send_error}")
+
+async def ask_llm(session_id: str, content: str, reply=None):
+    """Send content to the session's LlmChat, streaming into reply when given"""
+    # Get or create the session's context and build this request's chat
+    context = await get_chat_context(session_id)
+    chat, content = context.prepare(content, await catalog_context(content))
+    
+    # Send message to AI, bounded by the global LLM concurrency limit
+    user_message = UserMessage(text=content)
+    global llm_in_flight
+    async with llm_semaphore:
+        llm_in_flight += 1
+        started = time.perf_counter()
+        try:
+            if reply:
+                async for chunk in stream_ai_response(chat, user_message):
+                    reply.feed(chunk)
+                response = reply.text
+            else:
+                response = await chat.send_message(user_message)
+        finally:
+            llm_in_flight -= 1
+            observe("llm_request_seconds", time.perf_counter() - started, streamed=str(bool(reply)).lower())
+    
+    context.record(content, response)
+    return response
+
+async def stream_ai_response(chat, user_message):
+    """Yield response chunks, or the whole completion when the client can't stream"""
+    stream_message = getattr(chat, "stream_message", None)
+    if stream_message is None:
+        yield await chat.send_message(user_message)
+        return
+    async for chunk in stream_message(user_message):
+        yield chunk
+
+def split_discord_message(text: str, limit: int = DISCORD_MESSAGE_LIMIT):
+    """Split text into Discord-sized parts, preferring line breaks.
+
+    A part's boundary only depends on the text before it, so parts stay
+    stable while a streamed reply keeps growing.
+    """
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = text.rfind(" ", 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if text.strip():
+        parts.append(text)
+    return parts
+
+async def wait_for_edit_slot(channel_id):
+    """Reserve the channel's next streamed-edit slot and sleep until it"""
+    now = time.monotonic()
+    if len(stream_edit_slots) > 1000:
+        for stale in [key for key, slot in stream_edit_slots.items() if slot < now]:
+            del stream_edit_slots[stale]
+    slot = max(now, stream_edit_slots.get(channel_id, 0.0))
+    stream_edit_slots[channel_id] = slot + AI_STREAM_EDIT_INTERVAL
+    if slot > now:
+        await asyncio.sleep(slot - now)
+
+async def timed_discord(operation: str, request):
+    """Await a Discord API call, recording its latency"""
+    started = time.perf_counter()
+    try:
+        return await request
+    finally:
+        observe("discord_request_seconds", time.perf_counter() - started, operation=operation)
+
+async def send_long_message(channel, text: str):
+    """Send text, splitting it over several messages if needed"""
+    for part in split_discord_message(text):
+        await timed_discord("send", channel.send(part))
+
+class StreamedReply:
+    """Discord reply edited progressively as LLM tokens arrive.
+
+    feed() only appends text; a background task renders it, taking the
+    channel's edit slots (see wait_for_edit_slot), so a slow or rate-limited
+    edit never holds up the LLM stream. Text past the 2000 character limit
+    continues in new messages.
+    """
+    
+    def __init__(self, channel):
+        self.channel = channel
+        self.text = ""
+        self.messages = []
+        self._shown = []
+        self._dirty = asyncio.Event()
+        self._finished = False
+        self._task = None
+    
+    async def start(self):
+        self.messages.append(await timed_discord("send", self.channel.send(AI_STREAM_PLACEHOLDER)))
+        self._shown.append(AI_STREAM_PLACEHOLDER)
+        # Give the first tokens a moment to arrive before the first edit
+        stream_edit_slots[self.channel.id] = max(stream_edit_slots.get(self.channel.id, 0.0), time.monotonic() + AI_STREAM_EDIT_INTERVAL)
+        self._task = asyncio.create_task(self._run())
+    
+    def feed(self, chunk: str):
+        self.text += chunk
+        self._dirty.set()
+    
+    async def finish(self, text: str = None):
+        """Show the final text; returns once it has been rendered"""
+        if text is not None:
+            self.text = text
+        self._finished = True
+        self._dirty.set()
+        await self._task
+    
+    def abort(self):
+        if self._task is not None:
+            self._task.cancel()
+    
+    async def _run(self):
+        while True:
+            await self._dirty.wait()
+            await wait_for_edit_slot(self.channel.id)
+            self._dirty.clear()
+            finished = self._finished
+            try:
+                await self._render()
+            except Exception as e:
+                if finished:
+                    raise
+                print(f"Erro ao atualizar resposta em streaming: {e}")
+            if finished:
+                return
+
+    async def _render(self):
+        parts = split_discord_message(self.text) or [AI_STREAM_PLACEHOLDER]
+        for i, part in enumerate(parts):
+            if i < len(self.messages):
+                if self._shown[i] != part:
+                    await timed_discord("edit", self.messages[i].edit(content=part))
+                    self._shown[i] = part
+            else:
+                self.messages.append(await timed_discord("send", self.channel.send(part)))
+                self._shown.append(part)
+        # A replaced (e.g. fallback) text may need fewer messages than were sent
+        while len(self.messages) > len(parts):
+            await self.messages.pop().delete()
+            self._shown.pop()
+
+async def get_chat_context(session_id: str):
+    """Get a cached ChatContext, rebuilding evicted ones from stored conversations"""
+    context = ai_chat_sessions.get(session_id)
+    if context is not None:
+        return context
+    
+    turns = []
+    summary = ""
+    try:
+        recent = await db.conversations.find(
+            {"session_id": session_id},
+            {"_id": 0, "message": 1, "ai_response": 1}
+        ).sort("timestamp", -1).limit(AI_CONTEXT_WINDOW_TURNS).to_list(AI_CONTEXT_WINDOW_TURNS)
+        turns = [(turn["message"], turn["ai_response"]) for turn in reversed(recent)]
+        memory = await db.conversation_memories.find_one({"session_id": session_id}, {"_id": 0, "summary": 1})
+        if memory:
+            summary = memory.get("summary", "")
+    except Exception as e:
+        print(f"Erro ao recuperar histórico da sessão {session_id}: {e}")
+    
+    context = ChatContext(session_id, turns, summary)
+    ai_chat_sessions.put(session_id, context)
+    return context
+
+def classify_intent(text: str) -> Optional[str]:
+    """Match text against the deterministic intents (accent/case-insensitive)"""
+    match = INTENT_ROUTER.search(normalize_text(text))
+    return match.lastgroup if match else None
+
+async def handle_intent(intent: str, message):
+    """Answer a deterministic intent directly; returns the text to log"""
+    if intent == "list_products":
+        await handle_product_listing(message)
+        return "[lista de produtos]"
+    if intent == "add_product":
+        await handle_product_creation(message)
+        return ADD_PRODUCT_INSTRUCTIONS
+    response = INTENT_RESPONSES[intent]
+    await send_long_message(message.channel, response)
+    return response
 
 async def handle_message_without_ai(message_content):
     """Handle messages when AI is not available"""
-    message_lower = message_content.lower()
+    counters["ai_fallback_total"] += 1
+    intent = classify_intent(message_content)
     
-    if "ola" in message_lower or "oi" in message_lower or "hello" in message_lower:
+    if intent == "greeting":
         return "Olá! Sou o assistente do servidor. Como a IA está temporariamente indisponível, use os comandos:\n• `!produtos` - Ver produtos\n• `!adicionar_produto [nome] [preço]` - Adicionar produto\n• `!config_canal_ai` - Configurar canal"
     
-    elif "produto" in message_lower and "adicionar" in message_lower:
+    elif intent == "add_product":
         return "Para adicionar produtos, use: `!adicionar_produto [nome] [preço] [descrição] [categoria] [estoque]`\nExemplo: `!adicionar_produto Netflix 25.99 'Conta Premium' streaming 5`"
     
-    elif "produto" in message_lower and ("mostrar" in message_lower or "listar" in message_lower):
+    elif intent == "list_products":
         return "Para ver todos os produtos, use o comando: `!produtos`"
     
-    elif "ajuda" in message_lower or "help" in message_lower:
+    elif intent == "help":
         return """🤖 **Comandos Disponíveis:**
         
 • `!produtos` - Lista todos os produtos
+• `!buscar [termos]` - Busca produtos
 • `!adicionar_produto [nome] [preço] [desc] [categoria] [estoque]` - Adiciona produto
 • `!config_canal_ai` - Configura este canal para IA
 
@@ -230,41 +1495,28 @@ async def handle_message_without_ai(message_content):
     else:
         return f"Recebi sua mensagem: '{message_content}'\n\nComo a IA está indisponível, use:\n• `!ajuda` - Ver comandos\n• `!produtos` - Ver produtos\n• `!adicionar_produto` - Adicionar produto"
 
-async def handle_product_creation(message, ai_response):
+async def handle_product_creation(message):
     """Handle product creation from AI conversation"""
     try:
-        # Extract product info from message (basic parsing)
-        content = message.content.lower()
-        
-        # Send AI response first
-        await message.channel.send(ai_response)
-        
-        # Ask for more details if needed
-        await message.channel.send("Para adicionar o produto, preciso de mais algumas informações. Use o comando completo: `!adicionar_produto nome preço descrição categoria estoque`")
+        # Ask for the details the command needs
+        await message.channel.send(ADD_PRODUCT_INSTRUCTIONS)
         
     except Exception as e:
         print(f"Erro ao criar produto: {e}")
         await message.channel.send("Erro ao processar criação do produto.")
 
-async def handle_product_listing(message):
+async def handle_product_listing(message, page: int = 1):
     """Handle product listing"""
     try:
-        products = await db.products.find({"active": True}).to_list(100)
+        snapshot = await catalog_snapshot.get()
         
-        if not products:
+        pages = snapshot.page_count()
+        if not pages:
             await message.channel.send("Nenhum produto cadastrado ainda.")
             return
         
-        embed = discord.Embed(title="🛒 Produtos Disponíveis", color=0x00ff00)
-        
-        for product in products:
-            embed.add_field(
-                name=f"{product['name']} - R$ {product['price']:.2f}",
-                value=f"{product.get('description', 'Sem descrição')}\nEstoque: {product.get('stock', 0)}",
-                inline=False
-            )
-        
-        await message.channel.send(embed=embed)
+        page = min(max(page, 1), pages)
+        await timed_discord("send", message.channel.send(embed=snapshot.page(page)))
         
     except Exception as e:
         print(f"Erro ao listar produtos: {e}")
@@ -289,6 +1541,7 @@ async def add_product_command(ctx, nome: str, preco: float, *, resto: str = ""):
         )
         
         await db.products.insert_one(product.dict())
+        await catalog_changed(product.dict())
         
         embed = discord.Embed(title="✅ Produto Adicionado", color=0x00ff00)
         embed.add_field(name="Nome", value=nome, inline=True)
@@ -304,9 +1557,33 @@ async def add_product_command(ctx, nome: str, preco: float, *, resto: str = ""):
         await ctx.send(f"Erro ao adicionar produto: {e}")
 
 @bot.command(name='produtos')
-async def list_products_command(ctx):
+async def list_products_command(ctx, pagina: int = 1):
     """Comando para listar produtos"""
-    await handle_product_listing(ctx.message)
+    await handle_product_listing(ctx.message, pagina)
+
+@bot.command(name='buscar')
+async def search_products_command(ctx, *, termos: str = ""):
+    """Comando para buscar produtos"""
+    if not termos.strip():
+        await ctx.send("Use `!buscar termos` para procurar produtos. Ex.: `!buscar netflix`")
+        return
+    try:
+        await catalog_snapshot.get()
+        total, products, facets = product_index.query(termos, limit=PRODUCTS_PER_EMBED)
+        if not products:
+            await ctx.send(f"Nenhum produto encontrado para \"{termos}\".")
+            return
+        
+        embed = render_product_embeds(products)[0]
+        embed.title = f"🔎 Resultados para \"{termos}\""[:EMBED_FIELD_NAME_LIMIT]
+        footer = f"{total} produto(s) encontrado(s)"
+        if len(facets) > 1:
+            footer += " · " + ", ".join(f"{name} ({count})" for name, count in list(facets.items())[:5])
+        embed.set_footer(text=footer)
+        await timed_discord("send", ctx.send(embed=embed))
+    except Exception as e:
+        print(f"Erro ao buscar produtos: {e}")
+        await ctx.send("Erro ao buscar produtos.")
 
 @bot.command(name='config_canal_ai')
 async def config_ai_channel(ctx, channel_id: str = None):
@@ -322,10 +1599,648 @@ async def config_ai_channel(ctx, channel_id: str = None):
         {"$set": {"ai_channel_id": channel_id}},
         upsert=True
     )
+    await guild_config_changed(guild_id)
     
     await ctx.send(f"Canal de IA configurado para <#{channel_id}>")
 
 # Helper functions
+# Indexes the hot queries rely on: (collection, keys, options)
+REQUIRED_INDEXES = [
+    ("products", [("id", 1)], {"unique": True}),
+    ("products", [("active", 1), ("created_at", -1), ("id", -1)], {}),
+    ("products", [("sku", 1)], {"unique": True, "partialFilterExpression": {"sku": {"$type": "string"}}}),
+    ("bot_configs", [("guild_id", 1)], {"unique": True}),
+    ("payment_transactions", [("session_id", 1)], {"unique": True}),
+    ("payment_transactions", [("created_at", -1), ("id", -1)], {}),
+    ("payment_transactions", [("payment_status", 1), ("updated_at", 1)], {}),
+    ("payment_transactions", [("payment_status", 1), ("reservation.expires_at", 1)], {}),
+    ("stripe_events", [("event_id", 1)], {"unique": True}),
+    ("delivery_jobs", [("session_id", 1)], {"unique": True}),
+    ("bot_commands", [("created_at", 1)], {"expireAfterSeconds": 24 * 3600}),
+    ("rate_limits", [("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ("delivery_jobs", [("status", 1), ("next_attempt_at", 1)], {}),
+    ("delivery_jobs", [("status", 1), ("locked_until", 1)], {}),
+    ("stripe_events", [("received_at", 1)], {"expireAfterSeconds": STRIPE_EVENT_RETENTION}),
+    ("conversations", [("timestamp", -1), ("id", -1)], {}),
+    ("conversations", [("session_id", 1), ("timestamp", -1)], {}),
+    ("conversation_memories", [("session_id", 1)], {"unique": True}),
+    ("status_checks", [("timestamp", -1), ("id", -1)], {}),
+]
+
+# Queries checked by the index diagnostics endpoint: (name, collection, filter, sort)
+HOT_QUERIES = [
+    ("active_products", "products", {"active": True}, [("created_at", -1), ("id", -1)]),
+    ("product_by_id", "products", {"id": ""}, None),
+    ("product_by_sku", "products", {"sku": ""}, None),
+    ("guild_config", "bot_configs", {"guild_id": ""}, None),
+    ("transaction_by_session", "payment_transactions", {"session_id": ""}, None),
+    ("recent_transactions", "payment_transactions", {}, [("created_at", -1), ("id", -1)]),
+    ("pending_transactions", "payment_transactions", {"payment_status": "pending"}, [("updated_at", 1)]),
+    ("recent_conversations", "conversations", {}, [("timestamp", -1), ("id", -1)]),
+    ("session_history", "conversations", {"session_id": ""}, [("timestamp", -1)]),
+    ("recent_status_checks", "status_checks", {}, [("timestamp", -1), ("id", -1)]),
+]
+
+async def ensure_indexes():
+    """Create the required indexes (no-op for the ones that already exist)"""
+    for collection, keys, options in REQUIRED_INDEXES:
+        try:
+            await db[collection].create_index(keys, **options)
+        except Exception as e:
+            # e.g. duplicated guild_id rows block a unique index; keep starting up
+            print(f"Erro ao criar índice {collection}.{keys}: {e}")
+
+def find_plan_stages(plan: dict):
+    """Collect every stage name in an explain() plan tree"""
+    stages = [plan.get("stage")] if plan.get("stage") else []
+    for key in ("inputStage", "queryPlan"):
+        if isinstance(plan.get(key), dict):
+            stages += find_plan_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        stages += find_plan_stages(child)
+    return stages
+
+def json_default(value):
+    """JSON encoder fallback for Mongo documents"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+def encode_page_cursor(doc: dict, sort_field: str) -> str:
+    """Opaque cursor pointing just past doc in (sort_field, id) descending order"""
+    raw = json.dumps({"t": doc[sort_field].isoformat(), "id": doc["id"]})
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_page_cursor(token: str):
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        return datetime.fromisoformat(raw["t"]), str(raw["id"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
+async def stream_json_array(documents):
+    """Serialize documents as a JSON array, one document per chunk"""
+    yield "["
+    first = True
+    for doc in documents:
+        yield ("" if first else ",") + json.dumps(doc, default=json_default)
+        first = False
+    yield "]"
+
+async def iter_lines(chunks):
+    """Split a stream of byte chunks into text lines without buffering the stream"""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        lines = pending.split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line.rstrip("\r")
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending.rstrip("\r")
+
+async def iter_import_rows(lines, fmt: str):
+    """Yield (row number, record) from CSV or NDJSON lines; unparseable rows yield an error string"""
+    number = 0
+    if fmt == "ndjson":
+        async for line in lines:
+            number += 1
+            if not line.strip():
+                continue
+            if len(line) > PRODUCT_IMPORT_MAX_RECORD_SIZE:
+                yield number, "Linha grande demais"
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield number, f"JSON inválido: {e}"
+                continue
+            yield number, record if isinstance(record, dict) else "A linha deve ser um objeto JSON"
+        return
+    
+    header = None
+    pending = []  # lines of the record being read
+    size = 0
+    in_quotes = False
+    
+    def feed(line: str):
+        """Add a line; return the (row number, record) pairs it completes"""
+        nonlocal header, number, pending, size, in_quotes
+        rows = []
+        queue = [line]
+        while queue:
+            line = queue.pop()
+            # A quoted field may contain line breaks: wait until the quotes balance
+            pending.append(line)
+            size += len(line) + 1
+            in_quotes ^= line.count('"') % 2 == 1
+            if size > PRODUCT_IMPORT_MAX_RECORD_SIZE or len(pending) > PRODUCT_IMPORT_MAX_RECORD_LINES:
+                number += 1
+                rows.append((number, "Registro grande demais ou aspas não fechadas"))
+                if in_quotes:
+                    # Most likely a stray quote: re-read the lines after the one that opened it
+                    queue.extend(reversed(pending[1:]))
+                pending, size, in_quotes = [], 0, False
+                continue
+            if in_quotes:
+                continue
+            text = "\n".join(pending)
+            pending, size = [], 0
+            if header is None:
+                header = [column.strip().lower() for column in next(csv.reader([text]))]
+                continue
+            number += 1
+            if text.strip():
+                rows.append((number, dict(zip(header, next(csv.reader([text]))))))
+        return rows
+    
+    async for line in lines:
+        for row in feed(line):
+            yield row
+    while pending:
+        rest = pending[1:]
+        pending, size, in_quotes = [], 0, False
+        number += 1
+        yield number, "Aspas não fechadas no fim do arquivo"
+        for line in rest:
+            for row in feed(line):
+                yield row
+
+async def import_products(rows):
+    """Validate rows against ProductCreate and upsert them by SKU in batches"""
+    report = {"processed": 0, "inserted": 0, "updated": 0, "failed": 0, "errors": []}
+    
+    def fail(number: int, error: str, sku: Optional[str] = None):
+        report["failed"] += 1
+        if len(report["errors"]) < PRODUCT_IMPORT_MAX_ERRORS:
+            report["errors"].append({"row": number, "sku": sku, "error": error})
+    
+    async def write(batch):
+        now = datetime.utcnow()
+        operations = []
+        for _, product in batch:
+            # Columns left out only fill in defaults for new products
+            fields = product.dict(exclude_unset=True)
+            defaults = {key: value for key, value in product.dict().items() if key not in fields}
+            operations.append(UpdateOne(
+                {"sku": product.sku},
+                {"$set": {**fields, "active": True}, "$setOnInsert": {**defaults, "id": str(uuid.uuid4()), "created_at": now}},
+                upsert=True
+            ))
+        try:
+            result = (await db.products.bulk_write(operations, ordered=False)).bulk_api_result
+        except BulkWriteError as e:
+            result = e.details
+            for error in result["writeErrors"]:
+                number, product = batch[error["index"]]
+                fail(number, error.get("errmsg", "Erro de escrita"), product.sku)
+        report["inserted"] += result["nUpserted"]
+        report["updated"] += result["nMatched"]
+        if result["nUpserted"] or result["nMatched"]:
+            skus = [product.sku for _, product in batch]
+            written = await db.products.find({"sku": {"$in": skus}}, {"_id": 0}).sort("created_at", 1).to_list(None)
+            await catalog_changed(*written)
+    
+    batch = []
+    async for number, record in rows:
+        report["processed"] += 1
+        if isinstance(record, str):
+            fail(number, record)
+            continue
+        # Empty cells fall back to the model defaults
+        record = {key: value for key, value in record.items() if key and value not in ("", None)}
+        sku = str(record.get("sku", "")).strip()
+        if not sku:
+            fail(number, "sku é obrigatório")
+            continue
+        record["sku"] = sku
+        try:
+            batch.append((number, ProductCreate(**record)))
+        except ValidationError as e:
+            fail(number, "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors()), sku)
+            continue
+        if len(batch) >= PRODUCT_IMPORT_BATCH:
+            await write(batch)
+            batch = []
+    if batch:
+        await write(batch)
+    
+    report["errors_truncated"] = report["failed"] > len(report["errors"])
+    return report
+
+async def stream_export(cursor, fmt: str):
+    """Serialize a product cursor as CSV or NDJSON in EXPORT_CHUNK_SIZE pieces"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == "csv":
+        writer.writerow(PRODUCT_EXPORT_FIELDS)
+    async for doc in cursor:
+        if fmt == "csv":
+            writer.writerow([
+                json_default(value) if isinstance(value, datetime) else value
+                for value in (doc.get(field) for field in PRODUCT_EXPORT_FIELDS)
+            ])
+        else:
+            buffer.write(json.dumps(doc, default=json_default) + "\n")
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+async def paginated_response(collection, query: dict, sort_field: str, limit: int, after: Optional[str], fields: Optional[str]):
+    """Stream one keyset page of collection, newest first.
+
+    Pages are ordered by (sort_field, id) descending. One query reads up to
+    limit + 1 rows: the extra row only says whether another page exists, and
+    the X-Next-Cursor header points past the last row actually returned, so
+    concurrent inserts can't make a page skip records.
+    """
+    query = dict(query)
+    if after:
+        after_value, after_id = decode_page_cursor(after)
+        query["$or"] = [
+            {sort_field: {"$lt": after_value}},
+            {sort_field: after_value, "id": {"$lt": after_id}},
+        ]
+    
+    projection = {"_id": 0}
+    if fields:
+        projection.update({field.strip(): 1 for field in fields.split(",") if field.strip()})
+        projection.update({"id": 1, sort_field: 1})
+    sort = [(sort_field, -1), ("id", -1)]
+    
+    headers = {}
+    docs = await collection.find(query, projection).sort(sort).limit(limit + 1).to_list(limit + 1)
+    if len(docs) > limit:
+        docs = docs[:limit]
+        headers["X-Next-Cursor"] = encode_page_cursor(docs[-1], sort_field)
+    return StreamingResponse(stream_json_array(docs), media_type="application/json", headers=headers)
+
+def paginate_products(products):
+    """Split the product listing into pages of embed fields within Discord's embed limits"""
+    pages = []
+    fields = []
+    size = 0
+    for product in products:
+        name = f"{product['name']} - R$ {product['price']:.2f}"[:EMBED_FIELD_NAME_LIMIT]
+        value = f"{product.get('description') or 'Sem descrição'}\nEstoque: {product.get('stock', 0)}"[:EMBED_FIELD_VALUE_LIMIT]
+        if fields and (len(fields) >= PRODUCTS_PER_EMBED or size + len(name) + len(value) > EMBED_TOTAL_LIMIT):
+            pages.append(fields)
+            fields, size = [], 0
+        fields.append((name, value))
+        size += len(name) + len(value)
+    if fields:
+        pages.append(fields)
+    return pages
+
+def render_product_page(fields, number: int, total: int):
+    """Render one page of the product listing"""
+    title = "🛒 Produtos Disponíveis"
+    if total > 1:
+        title += f" ({number}/{total})"
+    embed = discord.Embed(title=title, color=0x00ff00)
+    for name, value in fields:
+        embed.add_field(name=name, value=value, inline=False)
+    if number < total:
+        embed.set_footer(text=f"Use !produtos {number + 1} para ver a próxima página")
+    return embed
+
+def render_product_embeds(products):
+    """Render the product listing as embeds within Discord's embed limits"""
+    pages = paginate_products(products)
+    return [render_product_page(fields, number, len(pages)) for number, fields in enumerate(pages, start=1)]
+
+class CatalogSnapshot:
+    """Versioned in-memory copy of the active catalog.
+
+    Writes made by this process are applied by product id with apply() and
+    remove(); invalidate() only bumps the version, and the next get() reloads
+    everything once, however many callers are waiting. Snapshots older than
+    CATALOG_SNAPSHOT_TTL are reloaded too, to pick up writes made by other
+    processes. Listing embeds are rendered per page, when a page is asked for.
+    """
+    
+    def __init__(self, ttl: float, index):
+        self.ttl = ttl
+        self.index = index
+        self.version = 0
+        self.products = {}  # product id -> product, oldest first
+        self._pages = None  # embed fields per page, rebuilt after a change
+        self._embeds = {}  # page number -> rendered embed
+        self._loaded_version = None
+        self._loaded_at = 0.0
+        self._lock = asyncio.Lock()
+    
+    def invalidate(self):
+        self.version += 1
+    
+    def apply(self, product: dict):
+        """Insert or update one product in place"""
+        if not product.get("active", True):
+            self.remove(product["id"])
+            return
+        if self._lock.locked():
+            # A reload is reading the collection and may miss this write
+            self.invalidate()
+        self.products[product["id"]] = product
+        self.index.add(product)
+        self._changed()
+    
+    def remove(self, product_id: str):
+        if self._lock.locked():
+            self.invalidate()
+        if self.products.pop(product_id, None) is not None:
+            self.index.remove(product_id)
+            self._changed()
+    
+    def _changed(self):
+        self._pages = None
+        self._embeds.clear()
+    
+    def page_count(self):
+        if self._pages is None:
+            self._pages = paginate_products(self.products.values())
+        return len(self._pages)
+    
+    def page(self, number: int):
+        """Listing embed for page number (1-based)"""
+        embed = self._embeds.get(number)
+        if embed is None:
+            total = self.page_count()
+            embed = self._embeds[number] = render_product_page(self._pages[number - 1], number, total)
+        return embed
+    
+    def is_fresh(self):
+        return self._loaded_version == self.version and time.monotonic() - self._loaded_at < self.ttl
+    
+    async def get(self):
+        if self.is_fresh():
+            return self
+        async with self._lock:
+            if not self.is_fresh():
+                version = self.version
+                products = await db.products.find({"active": True}, {"_id": 0}).sort("created_at", 1).to_list(None)
+                self.products = {product["id"]: product for product in products}
+                self.index.sync(products)
+                self._changed()
+                self._loaded_version = version
+                self._loaded_at = time.monotonic()
+        return self
+
+def search_terms(text: str):
+    """Index terms of text: normalized words minus stopwords, naive plural stripping"""
+    terms = []
+    for word in normalize_text(text).split():
+        if word in SEARCH_STOPWORDS:
+            continue
+        if len(word) > 3 and word.endswith("s"):
+            word = word[:-1]
+        terms.append(word)
+    return terms
+
+class ProductIndex:
+    """BM25 inverted index over product name, category and description.
+
+    sync() takes the full active catalog and only re-tokenizes products whose
+    text changed, so reloading the snapshot after a stock update is cheap.
+    Name terms count double, since they are what users ask about.
+
+    search() ranks any-term matches for the AI prompt; query() is the
+    storefront search: all terms must match (the last one as a prefix),
+    with category and price filters and category facet counts.
+    """
+    
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.docs = {}  # product id -> (product, indexed text, term counts, length, category key)
+        self.postings = {}  # term -> {product id: term frequency}
+        self.categories = {}  # normalized category -> set of product ids
+        self.category_labels = {}  # normalized category -> category as first written
+        self.product_categories = {}  # product id -> normalized category
+        self.total_length = 0
+        self._sorted_terms = None  # rebuilt on the first prefix lookup after the vocabulary changes
+        self._by_name = None  # product ids by name, rebuilt on the first browse after a change
+    
+    @staticmethod
+    def indexed_text(product):
+        return (product.get("name") or "", product.get("category") or "", product.get("description") or "")
+    
+    def add(self, product):
+        text = self.indexed_text(product)
+        current = self.docs.get(product["id"])
+        if current is not None and current[1] == text:
+            self.docs[product["id"]] = (product,) + current[1:]
+            return
+        self.remove(product["id"])
+        
+        name, category, description = text
+        counts = {}
+        for term in search_terms(name) * 2 + search_terms(f"{category} {description}"):
+            counts[term] = counts.get(term, 0) + 1
+        length = sum(counts.values())
+        for term, frequency in counts.items():
+            posting = self.postings.get(term)
+            if posting is None:
+                posting = self.postings[term] = {}
+                self._sorted_terms = None
+            posting[product["id"]] = frequency
+        category_key = normalize_text(category)
+        self.categories.setdefault(category_key, set()).add(product["id"])
+        self.product_categories[product["id"]] = category_key
+        self.category_labels.setdefault(category_key, category)
+        self.docs[product["id"]] = (product, text, counts, length, category_key)
+        self.total_length += length
+        self._by_name = None
+    
+    def remove(self, product_id: str):
+        entry = self.docs.pop(product_id, None)
+        if entry is None:
+            return
+        for term in entry[2]:
+            posting = self.postings[term]
+            del posting[product_id]
+            if not posting:
+                del self.postings[term]
+                self._sorted_terms = None
+        del self.product_categories[product_id]
+        members = self.categories[entry[4]]
+        members.discard(product_id)
+        if not members:
+            del self.categories[entry[4]]
+            del self.category_labels[entry[4]]
+        self.total_length -= entry[3]
+        self._by_name = None
+    
+    def sync(self, products):
+        """Make the index match products, touching only what changed"""
+        live = set()
+        for product in products:
+            live.add(product["id"])
+            self.add(product)
+        for product_id in [product_id for product_id in self.docs if product_id not in live]:
+            self.remove(product_id)
+    
+    def _score(self, terms, scores: dict, restrict: bool = False):
+        """Add the BM25 contribution of terms to scores (only to its keys if restrict)"""
+        if not self.docs:
+            return
+        average_length = self.total_length / len(self.docs) or 1
+        for term in terms:
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (len(self.docs) - len(posting) + 0.5) / (len(posting) + 0.5))
+            for product_id, frequency in posting.items():
+                if restrict and product_id not in scores:
+                    continue
+                length = self.docs[product_id][3]
+                norm = frequency + self.k1 * (1 - self.b + self.b * length / average_length)
+                scores[product_id] = scores.get(product_id, 0) + idf * frequency * (self.k1 + 1) / norm
+    
+    def search(self, query: str, k: int):
+        """Top k products for query by BM25 score"""
+        if not self.docs:
+            return []
+        scores = {}
+        self._score(set(search_terms(query)), scores)
+        best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [self.docs[product_id][0] for product_id, _ in best]
+    
+    def expand_prefix(self, prefix: str):
+        """Indexed terms starting with prefix (at most SEARCH_MAX_PREFIX_TERMS)"""
+        if self._sorted_terms is None:
+            self._sorted_terms = sorted(self.postings)
+        terms = self._sorted_terms
+        expansions = []
+        i = bisect_left(terms, prefix)
+        while i < len(terms) and terms[i].startswith(prefix) and len(expansions) < SEARCH_MAX_PREFIX_TERMS:
+            expansions.append(terms[i])
+            i += 1
+        return expansions
+    
+    def query(self, text: str = "", category: Optional[str] = None, min_price: Optional[float] = None,
+              max_price: Optional[float] = None, limit: int = 20, offset: int = 0):
+        """Filtered catalog search; returns (total, products, category facets).
+
+        Facet counts apply every filter except the category one, so they
+        show where else the same query would find products.
+        """
+        terms = search_terms(text)
+        if not terms and min_price is None and max_price is None:
+            return self._browse(category, limit, offset)
+        if terms:
+            # Each group is matched by any of its terms; the last word is a prefix
+            groups = [[term] for term in terms[:-1]] + [self.expand_prefix(terms[-1])]
+            matches = []
+            for group in groups:
+                if len(group) == 1:
+                    matches.append(self.postings[group[0]] if group[0] in self.postings else {})
+                else:
+                    matches.append(set().union(*(self.postings[term] for term in group)))
+            matches.sort(key=len)
+            candidates = set(matches[0]).intersection(*matches[1:])
+        else:
+            candidates = self.docs
+        
+        if min_price is not None or max_price is not None:
+            low = float("-inf") if min_price is None else min_price
+            high = float("inf") if max_price is None else max_price
+            candidates = [product_id for product_id in candidates if low <= self.docs[product_id][0]["price"] <= high]
+        
+        facets = Counter(map(self.product_categories.get, candidates))
+        if category is not None:
+            candidates = self.categories.get(normalize_text(category), set()).intersection(candidates)
+        
+        wanted = offset + limit
+        if terms:
+            scores = dict.fromkeys(candidates, 0.0)
+            self._score(set(terms[:-1] + groups[-1]), scores, restrict=True)
+            page = heapq.nlargest(wanted, scores, key=scores.get)[offset:]
+        else:
+            page = heapq.nsmallest(wanted, candidates, key=lambda product_id: self.docs[product_id][1][0].lower())[offset:]
+        
+        return len(candidates), [self.docs[product_id][0] for product_id in page], self._facet_labels(facets)
+    
+    def _browse(self, category: Optional[str], limit: int, offset: int):
+        """Unfiltered listing by name, answered without scanning the catalog"""
+        if self._by_name is None:
+            self._by_name = sorted(self.docs, key=lambda product_id: self.docs[product_id][1][0].lower())
+        facets = {key: len(members) for key, members in self.categories.items()}
+        if category is None:
+            return len(self.docs), [self.docs[product_id][0] for product_id in self._by_name[offset:offset + limit]], self._facet_labels(facets)
+        
+        members = self.categories.get(normalize_text(category), set())
+        page = []
+        skipped = 0
+        for product_id in self._by_name:
+            if len(page) == limit:
+                break
+            if product_id in members:
+                if skipped < offset:
+                    skipped += 1
+                else:
+                    page.append(self.docs[product_id][0])
+        return len(members), page, self._facet_labels(facets)
+    
+    def _facet_labels(self, facets: dict):
+        return {self.category_labels[key]: count for key, count in sorted(facets.items(), key=lambda item: -item[1])}
+
+product_index = ProductIndex()
+catalog_snapshot = CatalogSnapshot(CATALOG_SNAPSHOT_TTL, product_index)
+
+async def catalog_context(question: str) -> str:
+    """Prompt block with the products most relevant to question ("" if none)"""
+    try:
+        await catalog_snapshot.get()
+    except Exception as e:
+        print(f"Erro ao carregar catálogo para a IA: {e}")
+    lines = []
+    budget = AI_CATALOG_TOKEN_BUDGET
+    for product in product_index.search(question, AI_CATALOG_TOP_K):
+        line = f"- {product['name']}: R$ {product['price']:.2f}, categoria {product.get('category') or 'geral'}, {'disponível' if product.get('stock', 0) > 0 else 'esgotado'}"
+        if product.get("description"):
+            line += f". {product['description']}"
+        budget -= estimate_tokens(line)
+        if budget < 0:
+            break
+        lines.append(line)
+    if not lines:
+        return ""
+    return "Produtos da loja relacionados à pergunta (use estes dados e não invente produtos nem preços):\n" + "\n".join(lines)
+
+def stock_status_kept(product: dict) -> bool:
+    """Whether product is still as available as the snapshot's copy says"""
+    previous = catalog_snapshot.products.get(product["id"])
+    return previous is not None and (previous.get("stock", 0) > 0) == (product.get("stock", 0) > 0)
+
+async def catalog_changed(*products, removed=(), stock_only: bool = False):
+    """Update everything derived from the product catalog, here and in other processes.
+
+    The written products (and removed ids) are applied to the snapshot by id;
+    with neither, the whole snapshot is reloaded. The AI only sees whether a
+    product is in stock, so cached answers survive stock-only changes unless
+    a product sold out or came back.
+    """
+    if stock_only:
+        stock_only = bool(products) and all(stock_status_kept(product) for product in products)
+    if products or removed:
+        for product in products:
+            catalog_snapshot.apply(product)
+        for product_id in removed:
+            catalog_snapshot.remove(product_id)
+    else:
+        catalog_snapshot.invalidate()
+    if not stock_only:
+        ai_response_cache.clear()
+    event_hub.publish_local("product", {})
+    await bump_cache_version("catalog")
+    if not stock_only:
+        await bump_cache_version("catalog_answers")
+
 async def setup_guild_ai(guild_id: str):
     """Setup AI for a guild"""
     try:
@@ -334,17 +2249,127 @@ async def setup_guild_ai(guild_id: str):
         if not config:
             bot_config = BotConfig(guild_id=guild_id)
             await db.bot_configs.insert_one(bot_config.dict())
+        await guild_config_changed(guild_id)
     except Exception as e:
         print(f"Erro ao configurar guild: {e}")
 
 async def get_bot_config(guild_id: str):
-    """Get bot configuration for guild"""
+    """Get bot configuration for guild (cached)"""
+    cached = guild_config_cache.get(guild_id)
+    if cached and cached[0] > time.monotonic():
+        guild_config_cache.move_to_end(guild_id)
+        counters["guild_config_cache_hits_total"] += 1
+        return cached[1]
+    counters["guild_config_cache_misses_total"] += 1
+    
     try:
         config = await db.bot_configs.find_one({"guild_id": guild_id})
-        return config
     except Exception as e:
         print(f"Erro ao buscar config: {e}")
         return None
+    
+    cache_guild_config(guild_id, config)
+    return config
+
+def cache_guild_config(guild_id: str, config):
+    """Store a guild config in the cache, evicting the least recently used entries"""
+    guild_config_cache[guild_id] = (time.monotonic() + GUILD_CONFIG_CACHE_TTL, config)
+    guild_config_cache.move_to_end(guild_id)
+    while len(guild_config_cache) > GUILD_CONFIG_CACHE_MAX:
+        guild_config_cache.popitem(last=False)
+
+def invalidate_guild_config(guild_id: str = None):
+    """Drop one guild (or every guild) from the config cache"""
+    if guild_id is None:
+        guild_config_cache.clear()
+    else:
+        guild_config_cache.pop(guild_id, None)
+
+async def watch_guild_configs():
+    """Invalidate cached configs changed by other processes.
+
+    Uses a change stream when Mongo supports it (replica set / sharded cluster)
+    and falls back to periodically reloading the cached guilds otherwise.
+    """
+    try:
+        async with db.bot_configs.watch(full_document="updateLookup") as stream:
+            async for change in stream:
+                doc = change.get("fullDocument") or {}
+                if doc.get("guild_id"):
+                    invalidate_guild_config(doc["guild_id"])
+                else:
+                    # Deletes/replaces without the document: drop everything
+                    invalidate_guild_config()
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"Change stream indisponível para bot_configs, usando polling: {e}")
+    
+    while True:
+        await asyncio.sleep(GUILD_CONFIG_POLL_INTERVAL)
+        guild_ids = list(guild_config_cache.keys())
+        if not guild_ids:
+            continue
+        try:
+            configs = await db.bot_configs.find({"guild_id": {"$in": guild_ids}}).to_list(len(guild_ids))
+        except Exception as e:
+            print(f"Erro ao recarregar configs: {e}")
+            continue
+        found = {config["guild_id"]: config for config in configs}
+        for guild_id in guild_ids:
+            if guild_id in guild_config_cache:
+                cache_guild_config(guild_id, found.get(guild_id))
+
+async def guild_config_changed(guild_id: str):
+    """Drop a written guild config here and in the other processes"""
+    invalidate_guild_config(guild_id)
+    await bump_cache_version("guild_configs")
+
+# What a process drops when another process bumps each counter
+CACHE_VERSION_HANDLERS = {
+    "catalog": lambda: catalog_snapshot.invalidate(),
+    "catalog_answers": lambda: ai_response_cache.clear(),
+    "guild_configs": lambda: invalidate_guild_config(),
+}
+
+async def bump_cache_version(name: str):
+    """Tell the other processes that the data behind counter name changed"""
+    try:
+        doc = await db.cache_versions.find_one_and_update(
+            {"_id": name},
+            {"$inc": {"version": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except Exception as e:
+        print(f"Erro ao publicar versão de cache {name}: {e}")
+        return
+    # Our own bump needs no local action, unless it also covers someone else's
+    if seen_cache_versions.get(name) == doc["version"] - 1:
+        seen_cache_versions[name] = doc["version"]
+
+async def check_cache_versions():
+    """Apply the invalidations other processes published since the last check"""
+    docs = await db.cache_versions.find({"_id": {"$in": list(CACHE_VERSION_HANDLERS)}}).to_list(None)
+    versions = {doc["_id"]: doc["version"] for doc in docs}
+    for name, handler in CACHE_VERSION_HANDLERS.items():
+        version = versions.get(name, 0)
+        seen = seen_cache_versions.get(name)
+        if seen is not None and version > seen:
+            handler()
+        if seen is None or version > seen:
+            seen_cache_versions[name] = version
+
+async def watch_cache_versions():
+    """Poll the cache_versions counters; runs in every process"""
+    while True:
+        try:
+            await check_cache_versions()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Erro ao verificar versões de cache: {e}")
+        await asyncio.sleep(CACHE_VERSION_POLL_INTERVAL)
 
 # API Routes
 @api_router.get("/")
@@ -353,11 +2378,50 @@ async def root():
 
 @api_router.get("/bot/status")
 async def get_bot_status():
-    return {"running": bot_running, "bot_user": str(bot.user) if bot.user else None}
+    if BOT_MODE == "api":
+        # One heartbeat document per bot worker (shard group)
+        cutoff = datetime.utcnow() - timedelta(seconds=3 * BOT_HEARTBEAT_INTERVAL)
+        states = await db.bot_state.find({"heartbeat_at": {"$gte": cutoff}}).to_list(None)
+        return {
+            "running": any(state.get("running") for state in states),
+            "bot_user": next((state["bot_user"] for state in states if state.get("bot_user")), None),
+            "guild_count": sum(state.get("guild_count", 0) for state in states),
+            "shards": sorted((shard for state in states for shard in state.get("shards", [])), key=lambda shard: shard["id"])
+        }
+    return local_bot_status()
+
+def local_bot_status():
+    """Status of the bot running in this process, with per-shard health"""
+    shards = []
+    for shard_id, shard in sorted(bot.shards.items()):
+        latency = shard.latency
+        shards.append({
+            "id": shard_id,
+            "latency_ms": round(latency * 1000, 1) if math.isfinite(latency) else None,
+            "closed": shard.is_closed(),
+            "guilds": sum(1 for guild in bot.guilds if guild.shard_id == shard_id)
+        })
+    return {
+        "running": bot_running,
+        "bot_user": str(bot.user) if bot.user else None,
+        "guild_count": len(bot.guilds),
+        "shards": shards
+    }
+
+async def send_bot_command(command: str):
+    """Queue a start/stop command for the bot worker"""
+    await db.bot_commands.insert_one({
+        "id": str(uuid.uuid4()),
+        "command": command,
+        "created_at": datetime.utcnow()
+    })
 
 @api_router.post("/bot/start")
 async def start_bot(background_tasks: BackgroundTasks):
     """Start Discord bot"""
+    if BOT_MODE == "api":
+        await send_bot_command("start")
+        return {"message": "Bot iniciando..."}
     if not bot_running:
         discord_token = os.environ.get('DISCORD_BOT_TOKEN')
         if not discord_token:
@@ -371,9 +2435,13 @@ async def start_bot(background_tasks: BackgroundTasks):
 async def stop_bot():
     """Stop Discord bot"""
     global bot_running
+    if BOT_MODE == "api":
+        await send_bot_command("stop")
+        return {"message": "Comando de desligamento enviado"}
     if bot_running and bot.is_ready():
         await bot.close()
         bot_running = False
+        event_hub.publish("bot", local_bot_status())
         return {"message": "Bot desligado com sucesso"}
     return {"message": "Bot já está desligado"}
 
@@ -384,19 +2452,72 @@ async def run_bot(token: str):
     except Exception as e:
         print(f"Erro ao iniciar bot: {e}")
 
+@api_router.get("/products/search")
+async def search_products(
+    q: str = "",
+    category: Optional[str] = None,
+    min_price: Optional[float] = Query(None, ge=0),
+    max_price: Optional[float] = Query(None, ge=0),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0)
+):
+    """Search active products (accent-insensitive, last word as a prefix) with category facets"""
+    await catalog_snapshot.get()
+    started = time.perf_counter()
+    total, products, facets = product_index.query(q, category, min_price, max_price, limit, offset)
+    observe("product_search_seconds", time.perf_counter() - started)
+    return {"total": total, "products": products, "facets": {"category": facets}}
+
 @api_router.get("/products", response_model=List[Product])
-async def get_products():
-    """Get all products"""
-    products = await db.products.find({"active": True}).to_list(100)
-    return [Product(**product) for product in products]
+async def get_products(
+    limit: int = Query(100, ge=1, le=1000),
+    after: Optional[str] = None,
+    fields: Optional[str] = None
+):
+    """Get active products, newest first (paginated via X-Next-Cursor)"""
+    return await paginated_response(db.products, {"active": True}, "created_at", limit, after, fields)
 
 @api_router.post("/products", response_model=Product)
 async def create_product(product: ProductCreate):
     """Create new product"""
     product_obj = Product(**product.dict())
-    await db.products.insert_one(product_obj.dict())
+    try:
+        await db.products.insert_one(product_obj.dict())
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="SKU já cadastrado")
+    await catalog_changed(product_obj.dict())
     return product_obj
 
+@api_router.post("/products/import")
+async def import_products_endpoint(
+    request: Request,
+    fmt: Optional[str] = Query(None, alias="format", pattern="^(csv|ndjson)$")
+):
+    """Bulk upsert products by SKU from a CSV or NDJSON request body.
+
+    The body is parsed as it arrives (e.g. curl --data-binary @produtos.csv
+    -H "Content-Type: text/csv"), so files larger than memory are fine.
+    CSV needs a header row; columns follow ProductCreate, sku is required.
+    """
+    if fmt is None:
+        fmt = "ndjson" if "json" in request.headers.get("content-type", "") else "csv"
+    return await import_products(iter_import_rows(iter_lines(request.stream()), fmt))
+
+@api_router.get("/products/export")
+async def export_products(
+    fmt: str = Query("ndjson", alias="format", pattern="^(csv|ndjson)$"),
+    include_inactive: bool = False
+):
+    """Stream the catalog as CSV or NDJSON"""
+    query = {} if include_inactive else {"active": True}
+    cursor = db.products.find(query, {"_id": 0}).sort("id", 1).batch_size(PRODUCT_IMPORT_BATCH)
+    media_type = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        stream_export(cursor, fmt),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename=produtos.{fmt}"}
+    )
+
 @api_router.delete("/products/{product_id}")
 async def delete_product(product_id: str):
     """Delete product"""
@@ -406,13 +2527,118 @@ async def delete_product(product_id: str):
     )
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Produto não encontrado")
+    await catalog_changed(removed=[product_id])
     return {"message": "Produto removido"}
 
+@api_router.get("/events")
+async def stream_events():
+    """Live dashboard feed (Server-Sent Events)"""
+    async def events():
+        queue = event_hub.subscribe()
+        try:
+            yield f"event: bot\ndata: {json.dumps(await get_bot_status())}\n\n"
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), SSE_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                data = {key: value for key, value in data.items() if key != "_id"}
+                yield f"event: {event}\ndata: {json.dumps(data, default=json_default)}\n\n"
+        finally:
+            event_hub.unsubscribe(queue)
+    
+    # X-Accel-Buffering stops nginx from buffering the stream
+    return StreamingResponse(events(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+@api_router.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics"""
+    lines = []
+    for name, value in counters.items():
+        lines += [f"# TYPE {name} counter", f"{name} {value}"]
+    
+    response_cache = ai_response_cache.stats()
+    gauges = {
+        "ai_chat_sessions": len(ai_chat_sessions),
+        "ai_session_queues": len(ai_session_queues),
+        "ai_session_queue_depth": sum(queue.qsize() for queue in ai_session_queues.values()),
+        "llm_requests_in_flight": llm_in_flight,
+        "conversation_sink_queue_depth": conversation_sink.queue.qsize(),
+        "ai_response_cache_entries": response_cache["entries"],
+        "ai_response_cache_hit_ratio": response_cache["hit_ratio"],
+        "guild_config_cache_entries": len(guild_config_cache),
+        "user_cache_entries": len(fetched_users),
+        "rate_limit_buckets": len(rate_limiter.buckets),
+        "event_subscribers": len(event_hub.subscribers),
+        "payments_breaker_open": int(payments_client.state() == "open"),
+    }
+    for name, value in gauges.items():
+        lines += [f"# TYPE {name} gauge", f"{name} {value}"]
+    
+    all_histograms = list(histograms.items()) + [
+        (("payments_request_seconds", (("method", method),)), histogram)
+        for method, histogram in payments_client.latency.items()
+    ]
+    typed = set()
+    for (name, labels), histogram in sorted(all_histograms, key=lambda item: item[0]):
+        if name not in typed:
+            lines.append(f"# TYPE {name} histogram")
+            typed.add(name)
+        label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+        snapshot = histogram.snapshot()
+        for bound, count in snapshot["buckets"].items():
+            bucket_labels = f'{label_text},le="{bound}"' if label_text else f'le="{bound}"'
+            lines.append(f"{name}_bucket{{{bucket_labels}}} {count}")
+        suffix = f"{{{label_text}}}" if label_text else ""
+        lines.append(f"{name}_sum{suffix} {snapshot['sum']}")
+        lines.append(f"{name}_count{suffix} {snapshot['count']}")
+    
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+@api_router.get("/ai/cache")
+async def get_ai_cache_stats():
+    """Get AI response cache hit/miss statistics"""
+    return ai_response_cache.stats()
+
+@api_router.post("/ai/cache/clear")
+async def clear_ai_cache():
+    """Clear AI response cache"""
+    ai_response_cache.clear()
+    return {"message": "Cache limpo"}
+
+@api_router.get("/diagnostics/indexes")
+async def get_index_diagnostics():
+    """Explain each hot query and flag collection scans"""
+    results = []
+    for name, collection, query, sort in HOT_QUERIES:
+        cursor = db[collection].find(query).limit(1)
+        if sort:
+            cursor = cursor.sort(sort)
+        try:
+            explain = await cursor.explain()
+            stages = find_plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+            results.append({
+                "query": name,
+                "collection": collection,
+                "stages": stages,
+                "collscan": "COLLSCAN" in stages
+            })
+        except Exception as e:
+            results.append({"query": name, "collection": collection, "error": str(e)})
+    return {"queries": results, "collscans": [r["query"] for r in results if r.get("collscan")]}
+
 @api_router.get("/conversations")
-async def get_conversations():
-    """Get recent conversations"""
-    conversations = await db.conversations.find().sort("timestamp", -1).limit(50).to_list(50)
-    return conversations
+async def get_conversations(
+    limit: int = Query(50, ge=1, le=1000),
+    after: Optional[str] = None,
+    fields: Optional[str] = None
+):
+    """Get recent conversations (paginated via X-Next-Cursor)"""
+    return await paginated_response(db.conversations, {}, "timestamp", limit, after, fields)
 
 @api_router.get("/bot/config/{guild_id}")
 async def get_guild_config(guild_id: str):
@@ -421,7 +2647,8 @@ async def get_guild_config(guild_id: str):
     if not config:
         raise HTTPException(status_code=404, detail="Configuração não encontrada")
     
-    # Remove MongoDB ObjectId
+    # Remove MongoDB ObjectId (copy, the cached document is shared)
+    config = dict(config)
     if '_id' in config:
         del config['_id']
     
@@ -435,6 +2662,7 @@ async def update_guild_config(guild_id: str, config_data: dict):
         {"$set": config_data},
         upsert=True
     )
+    await guild_config_changed(guild_id)
     return {"message": "Configuração atualizada"}
 
 # Payment APIs
@@ -442,21 +2670,28 @@ async def update_guild_config(guild_id: str, config_data: dict):
 async def create_checkout_session(purchase: Purchase):
     """Create Stripe checkout session for product purchase"""
     try:
-        # Get product details
-        product = await db.products.find_one({"id": purchase.product_id, "active": True})
+        # Reserve stock atomically; concurrent buyers can't both take the last unit
+        product = await db.products.find_one_and_update(
+            {"id": purchase.product_id, "active": True, "stock": {"$gte": purchase.quantity}},
+            {"$inc": {"stock": -purchase.quantity}},
+            {"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
         if not product:
-            raise HTTPException(status_code=404, detail="Produto não encontrado")
-        
-        # Check stock
-        if product.get("stock", 0) < purchase.quantity:
+            if not await db.products.find_one({"id": purchase.product_id, "active": True}, {"_id": 1}):
+                raise HTTPException(status_code=404, detail="Produto não encontrado")
             raise HTTPException(status_code=400, detail="Estoque insuficiente")
-        
+        await catalog_changed(product, stock_only=True)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Erro ao criar checkout: {e}")
+        raise HTTPException(status_code=500, detail=f"Erro ao criar checkout: {str(e)}")
+    
+    try:
         # Calculate total amount
         amount = float(product["price"]) * purchase.quantity
         
-        # Initialize Stripe
-        stripe_checkout = StripeCheckout(api_key=os.environ.get('STRIPE_API_KEY'))
-        
         # Create checkout session
         success_url = f"{purchase.origin_url}?session_id={{CHECKOUT_SESSION_ID}}&payment=success"
         cancel_url = f"{purchase.origin_url}?payment=cancelled"
@@ -468,6 +2703,8 @@ async def create_checkout_session(purchase: Purchase):
             "quantity": str(purchase.quantity),
             "bot_purchase": "true"
         }
+        if purchase.guild_id:
+            metadata["guild_id"] = purchase.guild_id
         
         checkout_request = CheckoutSessionRequest(
             amount=amount,
@@ -477,7 +2714,7 @@ async def create_checkout_session(purchase: Purchase):
             metadata=metadata
         )
         
-        session_response = await stripe_checkout.create_checkout_session(checkout_request)
+        session_response = await payments_client.create_checkout_session(checkout_request)
         
         # Create payment transaction record
         transaction = PaymentTransaction(
@@ -486,10 +2723,17 @@ async def create_checkout_session(purchase: Purchase):
             discord_user_id=purchase.discord_user_id,
             amount=amount,
             currency="brl",
-            metadata=metadata
+            metadata=metadata,
+            reservation={
+                "quantity": purchase.quantity,
+                "status": "held",
+                # Held until Stripe expires the session, plus some grace for late webhooks
+                "expires_at": datetime.utcnow() + timedelta(seconds=STRIPE_SESSION_TTL + RESERVATION_GRACE)
+            }
         )
         
         await db.payment_transactions.insert_one(transaction.dict())
+        event_hub.publish_local("transaction", transaction.dict())
         
         return {
             "url": session_response.url,
@@ -497,80 +2741,489 @@ async def create_checkout_session(purchase: Purchase):
         }
         
     except Exception as e:
+        # Give the reserved stock back
+        restocked = await db.products.find_one_and_update(
+            {"id": purchase.product_id},
+            {"$inc": {"stock": purchase.quantity}},
+            {"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+        if restocked:
+            await catalog_changed(restocked, stock_only=True)
         print(f"Erro ao criar checkout: {e}")
+        if isinstance(e, PaymentsUnavailable):
+            raise HTTPException(status_code=503, detail=str(e))
         raise HTTPException(status_code=500, detail=f"Erro ao criar checkout: {str(e)}")
 
 @api_router.get("/payments/status/{session_id}")
 async def get_payment_status(session_id: str):
-    """Check payment status and update transaction"""
+    """Get payment status (kept up to date by the webhook and the reconciler)"""
+    transaction = await db.payment_transactions.find_one({"session_id": session_id})
+    if not transaction:
+        raise HTTPException(status_code=404, detail="Transação não encontrada")
+    
+    return {
+        "payment_status": transaction.get("payment_status"),
+        "stripe_status": transaction.get("stripe_status"),
+        "delivered": transaction.get("delivered", False)
+    }
+
+@api_router.get("/payments/client")
+async def get_payments_client_stats():
+    """Get payments client breaker state and latency histograms"""
+    return payments_client.stats()
+
+@api_router.get("/deliveries")
+async def get_delivery_queue():
+    """Get delivery job counts by status and the dead-lettered jobs"""
+    counts = await db.delivery_jobs.aggregate([
+        {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+    ]).to_list(None)
+    dead = await db.delivery_jobs.find({"status": "dead"}, {"_id": 0}).sort("updated_at", -1).limit(50).to_list(50)
+    return {"counts": {row["_id"]: row["count"] for row in counts}, "dead": dead}
+
+@api_router.post("/deliveries/{session_id}/retry")
+async def retry_delivery(session_id: str):
+    """Requeue a dead-lettered delivery"""
+    result = await db.delivery_jobs.update_one(
+        {"session_id": session_id, "status": "dead"},
+        {"$set": {"status": "queued", "attempts": 0, "next_attempt_at": datetime.utcnow(), "updated_at": datetime.utcnow()}}
+    )
+    if result.modified_count == 0:
+        raise HTTPException(status_code=404, detail="Entrega não encontrada na dead-letter")
+    delivery_wakeup.set()
+    return {"message": "Entrega reenfileirada"}
+
+@api_router.post("/webhook/stripe")
+async def stripe_webhook(request: Request):
+    """Receive Stripe checkout events"""
+    payload = await request.body()
+    secret = os.environ.get('STRIPE_WEBHOOK_SECRET')
+    if not secret:
+        raise HTTPException(status_code=503, detail="Webhook do Stripe não configurado")
+    if not verify_stripe_signature(payload, request.headers.get("Stripe-Signature", ""), secret):
+        raise HTTPException(status_code=400, detail="Assinatura inválida")
+    
     try:
-        # Get transaction from database
-        transaction = await db.payment_transactions.find_one({"session_id": session_id})
-        if not transaction:
-            raise HTTPException(status_code=404, detail="Transação não encontrada")
-        
-        # If already processed as paid, return status
-        if transaction.get("payment_status") == "paid":
-            return {
+        event = json.loads(payload)
+        event_id = event["id"]
+        event_type = event["type"]
+        session = event["data"]["object"]
+    except Exception:
+        raise HTTPException(status_code=400, detail="Evento inválido")
+    
+    if event_type not in STRIPE_CHECKOUT_EVENTS:
+        return {"received": True}
+    
+    # Stripe delivers at least once: record the event id before acting on it
+    try:
+        await db.stripe_events.insert_one({
+            "event_id": event_id,
+            "type": event_type,
+            "session_id": session.get("id"),
+            "received_at": datetime.utcnow()
+        })
+    except DuplicateKeyError:
+        return {"received": True, "duplicate": True}
+    
+    try:
+        transaction = await db.payment_transactions.find_one({"session_id": session.get("id")})
+        if transaction:
+            payment_status = STRIPE_CHECKOUT_EVENTS[event_type] or session.get("payment_status")
+            await apply_checkout_status(transaction, session.get("status"), payment_status)
+    except Exception as e:
+        # Forget the event so Stripe's retry gets processed
+        await db.stripe_events.delete_one({"event_id": event_id})
+        print(f"Erro ao processar evento {event_id}: {e}")
+        raise HTTPException(status_code=500, detail="Erro ao processar evento")
+    
+    return {"received": True}
+
+@api_router.get("/payments/transactions")
+async def get_payment_transactions(
+    limit: int = Query(100, ge=1, le=1000),
+    after: Optional[str] = None,
+    fields: Optional[str] = None
+):
+    """Get payment transactions, newest first (paginated via X-Next-Cursor)"""
+    return await paginated_response(db.payment_transactions, {}, "created_at", limit, after, fields)
+
+def verify_stripe_signature(payload: bytes, header: str, secret: str) -> bool:
+    """Check a Stripe-Signature header (t=timestamp,v1=hmac) against the payload"""
+    values = [part.split("=", 1) for part in header.split(",") if "=" in part]
+    timestamp = next((value for key, value in values if key == "t"), None)
+    signatures = [value for key, value in values if key == "v1"]
+    if not timestamp or not signatures or not timestamp.isdigit():
+        return False
+    if abs(time.time() - int(timestamp)) > STRIPE_WEBHOOK_TOLERANCE:
+        return False
+    expected = hmac.new(secret.encode(), timestamp.encode() + b"." + payload, hashlib.sha256).hexdigest()
+    return any(hmac.compare_digest(expected, signature) for signature in signatures)
+
+async def apply_checkout_status(transaction, stripe_status: str, payment_status: str):
+    """Move a transaction to the state Stripe reports.
+
+    Transitions are compare-and-set on payment_status, so when webhooks and
+    the reconciler race, only one of them delivers or releases stock.
+    """
+    session_id = transaction["session_id"]
+    
+    if payment_status == "paid":
+        claimed = await db.payment_transactions.find_one_and_update(
+            {"session_id": session_id, "payment_status": {"$ne": "paid"}},
+            {"$set": {
                 "payment_status": "paid",
-                "stripe_status": transaction.get("stripe_status"),
-                "delivered": transaction.get("delivered", False)
-            }
-        
-        # Check with Stripe
-        stripe_checkout = StripeCheckout(api_key=os.environ.get('STRIPE_API_KEY'))
-        stripe_status = await stripe_checkout.get_checkout_status(session_id)
+                "stripe_status": stripe_status,
+                "reservation.status": "committed",
+                "updated_at": datetime.utcnow()
+            }},
+            return_document=ReturnDocument.BEFORE
+        )
+        if not claimed:
+            # Already paid: a previous attempt may have died between the claim
+            # and the enqueue, so make sure the (idempotent) job exists
+            current = await db.payment_transactions.find_one({"session_id": session_id}, {"_id": 0, "payment_status": 1, "delivered": 1})
+            if current and current.get("payment_status") == "paid" and not current.get("delivered"):
+                await enqueue_delivery(session_id)
+            return
+        event_hub.publish_local("transaction", {"session_id": session_id, "payment_status": "paid", "stripe_status": stripe_status})
         
-        # Update transaction
-        update_data = {
-            "stripe_status": stripe_status.status,
-            "updated_at": datetime.utcnow()
-        }
+        # Legacy transactions and released reservations hold no stock: take it now
+        if claimed.get("reservation", {}).get("status") != "held":
+            product = await db.products.find_one_and_update(
+                {"id": claimed["product_id"]},
+                {"$inc": {"stock": -reserved_quantity(claimed)}},
+                {"_id": 0},
+                return_document=ReturnDocument.AFTER
+            )
+            if product:
+                await catalog_changed(product, stock_only=True)
         
-        # If payment is complete, process delivery
-        if stripe_status.payment_status == "paid" and transaction.get("payment_status") != "paid":
-            update_data["payment_status"] = "paid"
+        # Delivery runs on the delivery workers, off the webhook/reconciler path
+        await enqueue_delivery(session_id)
+    
+    elif payment_status == "failed" or stripe_status == "expired":
+        await release_reservation(session_id, "failed" if payment_status == "failed" else "expired", stripe_status)
+    
+    else:
+        await db.payment_transactions.update_one(
+            {"session_id": session_id, "payment_status": "pending"},
+            {"$set": {"stripe_status": stripe_status, "updated_at": datetime.utcnow()}}
+        )
+        event_hub.publish_local("transaction", {"session_id": session_id, "stripe_status": stripe_status})
+
+def reserved_quantity(transaction) -> int:
+    reservation = transaction.get("reservation") or {}
+    return int(reservation.get("quantity") or transaction.get("metadata", {}).get("quantity", 1))
+
+async def release_reservation(session_id: str, payment_status: str, stripe_status: str = None):
+    """Close a pending transaction and return its held stock (once)"""
+    update_data = {
+        "payment_status": payment_status,
+        "reservation.status": "released",
+        "updated_at": datetime.utcnow()
+    }
+    if stripe_status:
+        update_data["stripe_status"] = stripe_status
+    
+    released = await db.payment_transactions.find_one_and_update(
+        {"session_id": session_id, "payment_status": "pending"},
+        {"$set": update_data},
+        return_document=ReturnDocument.BEFORE
+    )
+    if released:
+        event_hub.publish_local("transaction", {"session_id": session_id, "payment_status": payment_status})
+    if released and released.get("reservation", {}).get("status") == "held":
+        product = await db.products.find_one_and_update(
+            {"id": released["product_id"]},
+            {"$inc": {"stock": reserved_quantity(released)}},
+            {"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+        if product:
+            await catalog_changed(product, stock_only=True)
+
+async def reconcile_pending_payments():
+    """Periodically ask Stripe about pending transactions the webhook hasn't settled"""
+    while True:
+        await asyncio.sleep(PAYMENT_RECONCILE_INTERVAL)
+        try:
+            # Stock held by sessions Stripe can no longer complete goes back on sale
+            stale = await db.payment_transactions.find(
+                {"payment_status": "pending", "reservation.expires_at": {"$lt": datetime.utcnow()}},
+                {"_id": 0, "session_id": 1}
+            ).limit(PAYMENT_RECONCILE_BATCH).to_list(PAYMENT_RECONCILE_BATCH)
+            for transaction in stale:
+                await release_reservation(transaction["session_id"], "expired")
             
-            # Process delivery (deliver product to Discord user)
-            delivery_success = await deliver_product_to_user(transaction)
-            update_data["delivered"] = delivery_success
+            cutoff = datetime.utcnow() - timedelta(seconds=PAYMENT_RECONCILE_MIN_AGE)
+            pending = await db.payment_transactions.find(
+                {"payment_status": "pending", "updated_at": {"$lt": cutoff}}
+            ).sort("updated_at", 1).limit(PAYMENT_RECONCILE_BATCH).to_list(PAYMENT_RECONCILE_BATCH)
+            if not pending:
+                continue
             
-            # Update product stock
-            if delivery_success:
-                quantity = int(transaction.get("metadata", {}).get("quantity", 1))
-                await db.products.update_one(
-                    {"id": transaction["product_id"]},
-                    {"$inc": {"stock": -quantity}}
-                )
-        
-        elif stripe_status.status == "expired":
-            update_data["payment_status"] = "expired"
-        
-        # Update transaction in database
+            for transaction in pending:
+                try:
+                    stripe_status = await payments_client.get_checkout_status(transaction["session_id"])
+                    await apply_checkout_status(transaction, stripe_status.status, stripe_status.payment_status)
+                except PaymentsUnavailable:
+                    # Breaker is open: try the rest of the batch on the next sweep
+                    break
+                except Exception as e:
+                    print(f"Erro ao reconciliar pagamento {transaction['session_id']}: {e}")
+                    # Move it to the back of the sweep order
+                    await db.payment_transactions.update_one(
+                        {"session_id": transaction["session_id"], "payment_status": "pending"},
+                        {"$set": {"updated_at": datetime.utcnow()}}
+                    )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Erro ao reconciliar pagamentos: {e}")
+
+async def enqueue_delivery(session_id: str):
+    """Queue delivery of a paid transaction (idempotent per session)"""
+    now = datetime.utcnow()
+    try:
+        await db.delivery_jobs.insert_one({
+            "id": str(uuid.uuid4()),
+            "session_id": session_id,
+            "status": "queued",
+            "attempts": 0,
+            "next_attempt_at": now,
+            "locked_until": None,
+            "last_error": None,
+            "created_at": now,
+            "updated_at": now
+        })
+    except DuplicateKeyError:
+        return
+    delivery_wakeup.set()
+
+async def claim_delivery_job():
+    """Lease the next due job, including ones whose worker died mid-delivery.
+
+    Each lease gets a fresh lease_id; later writes to the job filter on it, so
+    a worker whose lease expired and was taken over can't overwrite the job.
+    """
+    now = datetime.utcnow()
+    return await db.delivery_jobs.find_one_and_update(
+        {"$or": [
+            {"status": "queued", "next_attempt_at": {"$lte": now}},
+            {"status": "running", "locked_until": {"$lt": now}}
+        ]},
+        {
+            "$set": {
+                "status": "running",
+                "lease_id": str(uuid.uuid4()),
+                "locked_until": now + timedelta(seconds=DELIVERY_LEASE),
+                "updated_at": now
+            },
+            "$inc": {"attempts": 1}
+        },
+        sort=[("next_attempt_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def renew_delivery_lease(job) -> bool:
+    """Extend a job's lease; False if it expired and another worker took it"""
+    result = await db.delivery_jobs.update_one(
+        {"id": job["id"], "lease_id": job["lease_id"], "status": "running"},
+        {"$set": {"locked_until": datetime.utcnow() + timedelta(seconds=DELIVERY_LEASE)}}
+    )
+    # matched, not modified: a renewal in the claim's millisecond changes nothing
+    return result.matched_count == 1
+
+async def run_delivery_job(job, transaction):
+    """Attempt one delivery and schedule a retry or dead-letter it on failure"""
+    session_id = job["session_id"]
+    lease = {"id": job["id"], "lease_id": job["lease_id"]}
+    # Jobs later in a batch may have waited: start from a full lease, or skip
+    if not await renew_delivery_lease(job):
+        return
+    
+    error = None
+    try:
+        if transaction and transaction.get("delivered"):
+            # Delivered by an earlier lease whose completion write was lost
+            pass
+        elif not transaction:
+            error = "Transação não encontrada"
+        elif not bot.is_ready():
+            # Not the delivery's fault: retry soon without spending an attempt
+            await db.delivery_jobs.update_one(
+                lease,
+                {
+                    "$set": {
+                        "status": "queued",
+                        "next_attempt_at": datetime.utcnow() + timedelta(seconds=DELIVERY_RETRY_BASE),
+                        "locked_until": None,
+                        "last_error": "Bot desconectado",
+                        "updated_at": datetime.utcnow()
+                    },
+                    "$inc": {"attempts": -1}
+                }
+            )
+            return
+        elif not await deliver_product_to_user(transaction):
+            error = "Falha na entrega"
+    except Exception as e:
+        error = str(e)
+    
+    now = datetime.utcnow()
+    if error is None:
+        await db.delivery_jobs.update_one(
+            lease,
+            {"$set": {"status": "done", "locked_until": None, "last_error": None, "updated_at": now}}
+        )
         await db.payment_transactions.update_one(
             {"session_id": session_id},
-            {"$set": update_data}
+            {"$set": {"delivered": True, "updated_at": now}}
         )
+        event_hub.publish_local("transaction", {"session_id": session_id, "delivered": True})
+    elif job["attempts"] >= DELIVERY_MAX_ATTEMPTS:
+        print(f"Entrega {session_id} falhou {job['attempts']} vezes, movida para dead-letter: {error}")
+        await db.delivery_jobs.update_one(
+            lease,
+            {"$set": {"status": "dead", "locked_until": None, "last_error": error, "updated_at": now}}
+        )
+    else:
+        delay = min(DELIVERY_RETRY_BASE * 2 ** (job["attempts"] - 1), DELIVERY_RETRY_MAX)
+        await db.delivery_jobs.update_one(
+            lease,
+            {"$set": {
+                "status": "queued",
+                "next_attempt_at": now + timedelta(seconds=delay),
+                "locked_until": None,
+                "last_error": error,
+                "updated_at": now
+            }}
+        )
+
+async def delivery_worker():
+    """Drain the delivery queue; one of DELIVERY_WORKERS concurrent workers"""
+    while True:
+        if not bot.is_ready():
+            # Leave the jobs queued until the bot can reach users
+            await asyncio.sleep(DELIVERY_POLL_INTERVAL)
+            continue
+        try:
+            job = await claim_delivery_job()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Erro ao buscar entregas: {e}")
+            job = None
         
-        return {
-            "payment_status": update_data.get("payment_status", transaction.get("payment_status")),
-            "stripe_status": stripe_status.status,
-            "delivered": update_data.get("delivered", transaction.get("delivered", False))
-        }
+        if job is None:
+            delivery_wakeup.clear()
+            try:
+                await asyncio.wait_for(delivery_wakeup.wait(), DELIVERY_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        
+        # Draining a backlog: lease a batch so users can be resolved together
+        jobs = [job]
+        while len(jobs) < DELIVERY_CLAIM_BATCH:
+            try:
+                job = await claim_delivery_job()
+            except Exception:
+                job = None
+            if job is None:
+                break
+            jobs.append(job)
         
+        # Any failure below leaves the leases to expire, and the jobs get picked up again
+        try:
+            transactions = await db.payment_transactions.find(
+                {"session_id": {"$in": [job["session_id"] for job in jobs]}}
+            ).to_list(len(jobs))
+            by_session = {transaction["session_id"]: transaction for transaction in transactions}
+            if len(jobs) > 1:
+                await resolve_users([transaction.get("discord_user_id") for transaction in transactions])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Erro ao preparar entregas: {e}")
+            await asyncio.sleep(DELIVERY_POLL_INTERVAL)
+            continue
+        
+        for job in jobs:
+            try:
+                await run_delivery_job(job, by_session.get(job["session_id"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Erro na entrega {job['session_id']}: {e}")
+
+def cached_user(user_id: int):
+    """Find a user without a REST call: client cache (covers cached members), then fetched users"""
+    user = bot.get_user(user_id)
+    if user is not None:
+        return user
+    entry = fetched_users.get(user_id)
+    if entry and entry[0] > time.monotonic():
+        fetched_users.move_to_end(user_id)
+        return entry[1]
+    return None
+
+async def resolve_user(discord_user_id):
+    """Resolve a Discord user, only falling back to fetch_user on a cache miss"""
+    try:
+        user_id = int(discord_user_id)
+    except (TypeError, ValueError):
+        return None
+    
+    user = cached_user(user_id)
+    if user is not None:
+        counters["user_cache_hits_total"] += 1
+        return user
+    entry = fetched_users.get(user_id)
+    if entry and entry[0] > time.monotonic():
+        # Known not to exist
+        counters["user_cache_hits_total"] += 1
+        return None
+    counters["user_cache_misses_total"] += 1
+    
+    try:
+        user = await bot.fetch_user(user_id)
+    except discord.NotFound:
+        user = None
     except Exception as e:
-        print(f"Erro ao verificar status: {e}")
-        raise HTTPException(status_code=500, detail=f"Erro ao verificar status: {str(e)}")
+        # Transient (HTTP or connection error): don't cache the miss
+        print(f"Erro ao buscar usuário {user_id}: {e}")
+        return None
+    
+    fetched_users[user_id] = (time.monotonic() + USER_CACHE_TTL, user)
+    fetched_users.move_to_end(user_id)
+    while len(fetched_users) > USER_CACHE_MAX:
+        fetched_users.popitem(last=False)
+    return user
 
-@api_router.get("/payments/transactions")
-async def get_payment_transactions():
-    """Get all payment transactions"""
-    transactions = await db.payment_transactions.find().sort("created_at", -1).limit(100).to_list(100)
-    # Remove sensitive data
-    for transaction in transactions:
-        if '_id' in transaction:
-            del transaction['_id']
-    return transactions
+async def resolve_users(discord_user_ids):
+    """Resolve many users, fetching the cache misses concurrently"""
+    unique_ids = list(dict.fromkeys(i for i in discord_user_ids if i))
+    semaphore = asyncio.Semaphore(USER_FETCH_CONCURRENCY)
+    
+    async def resolve(user_id):
+        async with semaphore:
+            return await resolve_user(user_id)
+    
+    users = await asyncio.gather(*(resolve(user_id) for user_id in unique_ids))
+    return dict(zip(unique_ids, users))
+
+def delivery_guild_ids(transaction, user):
+    """Guilds whose shop channel can take a failed-DM delivery, best first"""
+    guild_ids = []
+    if transaction.get("metadata", {}).get("guild_id"):
+        guild_ids.append(transaction["metadata"]["guild_id"])
+    # Guilds on this process' shards where the buyer is a member
+    guild_ids.extend(str(guild.id) for guild in getattr(user, "mutual_guilds", []))
+    if os.environ.get('DISCORD_GUILD_ID'):
+        guild_ids.append(os.environ['DISCORD_GUILD_ID'])
+    return list(dict.fromkeys(guild_ids))
 
 async def deliver_product_to_user(transaction):
     """Deliver product to Discord user via DM or channel"""
@@ -584,9 +3237,8 @@ async def deliver_product_to_user(transaction):
             return False
         
         # Get Discord user
-        try:
-            user = await bot.fetch_user(int(discord_user_id))
-        except:
+        user = await resolve_user(discord_user_id)
+        if user is None:
             print(f"Usuário Discord {discord_user_id} não encontrado")
             return False
         
@@ -618,24 +3270,24 @@ async def deliver_product_to_user(transaction):
         
         # Send DM to user
         try:
-            await user.send(embed=embed)
+            await timed_discord("dm", user.send(embed=embed))
             print(f"Produto entregue via DM para {user.name}")
             return True
         except discord.Forbidden:
             # If DM fails, try to send in configured channel
             print(f"Não foi possível enviar DM para {user.name}, tentando canal público")
             
-            guild_id = os.environ.get('DISCORD_GUILD_ID')
-            config = await get_bot_config(guild_id)
-            
-            if config and config.get('shop_channel_id'):
+            for guild_id in delivery_guild_ids(transaction, user):
+                config = await get_bot_config(guild_id)
+                if not config or not config.get('shop_channel_id'):
+                    continue
                 try:
-                    channel = bot.get_channel(int(config['shop_channel_id']))
-                    if channel:
-                        await channel.send(f"<@{discord_user_id}>", embed=embed)
-                        return True
-                except:
-                    pass
+                    # Sends over REST, so it works whichever shard/process owns the guild
+                    channel = bot.get_partial_messageable(int(config['shop_channel_id']))
+                    await timed_discord("send", channel.send(f"<@{discord_user_id}>", embed=embed))
+                    return True
+                except discord.HTTPException as e:
+                    print(f"Erro ao entregar no canal da loja do servidor {guild_id}: {e}")
             
             return False
             
@@ -652,19 +3304,56 @@ async def create_status_check(input: StatusCheckCreate):
     return status_obj
 
 @api_router.get("/status", response_model=List[StatusCheck])
-async def get_status_checks():
-    status_checks = await db.status_checks.find().to_list(1000)
-    return [StatusCheck(**status_check) for status_check in status_checks]
+async def get_status_checks(
+    limit: int = Query(100, ge=1, le=1000),
+    after: Optional[str] = None,
+    fields: Optional[str] = None
+):
+    return await paginated_response(db.status_checks, {}, "timestamp", limit, after, fields)
 
 # Include the router in the main app
 app.include_router(api_router)
 
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    """Time each request until its body is sent.
+
+    Streamed endpoints (product list, export) only finish once the last chunk
+    is out, so the timer runs inside the body iterator. Event streams stay
+    open for as long as the dashboard does: for them it's time to headers.
+    """
+    started = time.perf_counter()
+    response = await call_next(request)
+    # Label by route template, not raw path, to keep cardinality bounded
+    route = request.scope.get("route")
+    labels = {
+        "route": getattr(route, "path", "unmatched"),
+        "method": request.method,
+        "status": str(response.status_code),
+    }
+    if response.headers.get("content-type", "").startswith("text/event-stream"):
+        observe("http_request_seconds", time.perf_counter() - started, **labels)
+        return response
+    
+    body = response.body_iterator
+    
+    async def timed_body():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            observe("http_request_seconds", time.perf_counter() - started, **labels)
+    
+    response.body_iterator = timed_body()
+    return response
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 # Configure logging
@@ -674,16 +3363,115 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+service_tasks = []
+app_tasks = []  # tasks every process runs, bot or API
+
+async def start_bot_services():
+    """Start the tasks that belong next to the Discord bot"""
+    service_tasks.append(asyncio.create_task(watch_guild_configs()))
+    service_tasks.append(asyncio.create_task(reconcile_pending_payments()))
+    service_tasks.extend(asyncio.create_task(delivery_worker()) for _ in range(DELIVERY_WORKERS))
+    conversation_sink.start()
+
+async def stop_bot_services():
+    for task in service_tasks:
+        task.cancel()
+    service_tasks.clear()
+    if bot.is_ready():
+        await bot.close()
+    # Flush buffered writes once nothing can produce new ones
+    await conversation_sink.close()
+
 @app.on_event("startup")
 async def startup_event():
     """Startup event"""
-    # Auto-start bot if tokens are available
-    discord_token = os.environ.get('DISCORD_BOT_TOKEN')
-    if discord_token and not bot_running:
-        asyncio.create_task(run_bot(discord_token))
+    await ensure_indexes()
+    app_tasks.append(asyncio.create_task(watch_cache_versions()))
+    
+    # In split mode the bot and its tasks live in bot_worker.py
+    if BOT_MODE != "api":
+        await start_bot_services()
+        
+        # Auto-start bot if tokens are available
+        discord_token = os.environ.get('DISCORD_BOT_TOKEN')
+        if discord_token and not bot_running:
+            asyncio.create_task(run_bot(discord_token))
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in app_tasks:
+        task.cancel()
+    if BOT_MODE != "api":
+        await stop_bot_services()
+    await payments_client.close()
     client.close()
-    if bot.is_ready():
-        await bot.close()
+
+async def publish_bot_state():
+    """Heartbeat the worker's bot state so API processes can report it"""
+    while True:
+        try:
+            status = local_bot_status()
+            status["running"] = bot_running and bot.is_ready()
+            status["heartbeat_at"] = datetime.utcnow()
+            await db.bot_state.update_one({"_id": BOT_INSTANCE_ID}, {"$set": status}, upsert=True)
+        except Exception as e:
+            print(f"Erro ao publicar estado do bot: {e}")
+        await asyncio.sleep(BOT_HEARTBEAT_INTERVAL)
+
+async def process_bot_commands():
+    """Execute start/stop commands queued by API processes.
+
+    Commands are broadcast: every worker (one per shard group) applies each
+    command issued after it started.
+    """
+    global bot_running
+    last_seen = datetime.utcnow()
+    while True:
+        try:
+            commands_due = await db.bot_commands.find(
+                {"created_at": {"$gt": last_seen}}
+            ).sort("created_at", 1).to_list(100)
+        except Exception as e:
+            print(f"Erro ao buscar comandos do bot: {e}")
+            commands_due = []
+        
+        for command in commands_due:
+            last_seen = command["created_at"]
+            if command["command"] == "start" and not bot_running:
+                discord_token = os.environ.get('DISCORD_BOT_TOKEN')
+                if discord_token:
+                    asyncio.create_task(run_bot(discord_token))
+            elif command["command"] == "stop" and bot_running and bot.is_ready():
+                await bot.close()
+                bot_running = False
+        
+        await asyncio.sleep(BOT_COMMAND_POLL_INTERVAL)
+
+async def run_worker():
+    """Standalone bot process for BOT_MODE=api deployments"""
+    await ensure_indexes()
+    await start_bot_services()
+    worker_tasks = [
+        asyncio.create_task(publish_bot_state()),
+        asyncio.create_task(process_bot_commands()),
+        asyncio.create_task(watch_cache_versions())
+    ]
+    
+    discord_token = os.environ.get('DISCORD_BOT_TOKEN')
+    if discord_token:
+        asyncio.create_task(run_bot(discord_token))
+    
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, lambda: [task.cancel() for task in worker_tasks])
+    
+    try:
+        await asyncio.gather(*worker_tasks)
+    except asyncio.CancelledError:
+        print("Encerrando worker do bot...")
+    finally:
+        for task in worker_tasks:
+            task.cancel()
+        await stop_bot_services()
+        await db.bot_state.update_one({"_id": BOT_INSTANCE_ID}, {"$set": {"running": False}})
+        client.close()
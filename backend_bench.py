@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+"""Load test / benchmark for the bot's hot paths, fully in-process.
+
+Drives on_message, AI turns, the product commands and the payment endpoints
+at a fixed arrival rate against fakes: Discord messages/channels, an LlmChat
+with tunable latency, a Stripe checkout client and a signed webhook emitter.
+Mongo is a local mongod (a throwaway *_bench database) or mongomock-motor.
+Needs the dev requirements: pip install -r backend/requirements-dev.txt
+
+    python backend_bench.py                       # all scenarios, 50 req/s, 10 s each
+    python backend_bench.py --scenario ai_turn --rate 200 --llm-latency 0.5
+    python backend_bench.py --save-baseline        # write bench_baseline.json
+    python backend_bench.py --baseline             # fail if p99 regressed vs baseline
+
+Reports p50/p99 latency, achieved throughput, errors and Python memory growth.
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).parent
+BASELINE_FILE = ROOT_DIR / "bench_baseline.json"
+
+# server.py reads its configuration at import time
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ["DB_NAME"] = os.environ.get("BENCH_DB_NAME", "discord_bot_bench")
+os.environ["STRIPE_WEBHOOK_SECRET"] = "whsec_bench"
+os.environ.setdefault("AI_COALESCE_WINDOW", "0")
+# Fake channels aren't rate limited: keep streamed-edit spacing from dominating ai_turn
+os.environ.setdefault("AI_STREAM_EDIT_INTERVAL", "0.1")
+sys.path.insert(0, str(ROOT_DIR / "backend"))
+
+SCENARIOS = ["on_message", "ai_turn", "product_listing", "add_product", "checkout", "webhook", "payment_status"]
+GUILD_ID = 1000
+AI_CHANNEL_ID = 2000
+OTHER_CHANNEL_ID = 2001
+AI_BENCH_CHANNELS = 20
+BENCH_STATUS_SESSIONS = 20
+
+# Fakes
+class FakeLlmChat:
+    """Stands in for emergentintegrations' LlmChat"""
+    latency = 0.2
+    chunks = 8
+
+    def __init__(self, api_key=None, session_id=None, system_message=None, initial_messages=None):
+        self.session_id = session_id
+        self.history = list(initial_messages or [])
+
+    def with_model(self, provider, model):
+        return self
+
+    async def send_message(self, user_message):
+        await asyncio.sleep(self.latency)
+        return self._answer(user_message)
+
+    async def stream_message(self, user_message):
+        answer = self._answer(user_message)
+        step = max(1, len(answer) // self.chunks)
+        for i in range(0, len(answer), step):
+            await asyncio.sleep(self.latency / self.chunks)
+            yield answer[i:i + step]
+
+    def _answer(self, user_message):
+        self.history.append(user_message.text)
+        return f"Resposta simulada para: {user_message.text} " + "lorem ipsum " * 20
+
+class FakeSentMessage:
+    def __init__(self, channel, content):
+        self.channel = channel
+        self.content = content
+
+    async def edit(self, content=None, **kwargs):
+        await asyncio.sleep(self.channel.latency)
+        self.content = content
+
+    async def delete(self):
+        await asyncio.sleep(self.channel.latency)
+
+class FakeChannel:
+    latency = 0.02
+
+    def __init__(self, channel_id):
+        self.id = channel_id
+
+    async def send(self, content=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        return FakeSentMessage(self, content)
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.name = f"user{user_id}"
+        self.bot = False
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+class FakeMessage:
+    def __init__(self, content, user_id, channel):
+        self.id = uuid.uuid4().int >> 64
+        self.content = content
+        self.author = FakeUser(user_id)
+        self.channel = channel
+        self.guild = FakeGuild(GUILD_ID)
+        self.answered = None
+
+class FakeContext:
+    def __init__(self, channel, user_id):
+        self.channel = channel
+        self.message = FakeMessage("", user_id, channel)
+        self.guild = FakeGuild(GUILD_ID)
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+class FakeStripeCheckout:
+    """Stands in for emergentintegrations' StripeCheckout"""
+    latency = 0.1
+
+    async def create_checkout_session(self, request):
+        await asyncio.sleep(self.latency)
+        session_id = f"cs_bench_{uuid.uuid4().hex}"
+        return type("Session", (), {"session_id": session_id, "url": f"https://stripe.invalid/{session_id}"})()
+
+    async def get_checkout_status(self, session_id):
+        await asyncio.sleep(self.latency)
+        return type("Status", (), {"status": "complete", "payment_status": "paid"})()
+
+def signed_stripe_event(session_id, event_type="checkout.session.completed"):
+    """Build a webhook body and Stripe-Signature header like Stripe would"""
+    payload = json.dumps({
+        "id": f"evt_{uuid.uuid4().hex}",
+        "type": event_type,
+        "data": {"object": {"id": session_id, "status": "complete", "payment_status": "paid"}}
+    }).encode()
+    timestamp = str(int(time.time()))
+    signature = hmac.new(b"whsec_bench", timestamp.encode() + b"." + payload, hashlib.sha256).hexdigest()
+    return payload, f"t={timestamp},v1={signature}"
+
+# Setup
+async def setup(server, mongo_mode):
+    if mongo_mode == "mock":
+        from mongomock_motor import AsyncMongoMockClient
+        server.client = AsyncMongoMockClient()
+        server.db = server.client[os.environ["DB_NAME"]]
+        server.conversation_sink.collection = server.db.conversations
+    elif not os.environ["DB_NAME"].endswith("_bench"):
+        raise SystemExit("Refusing to run against a database whose name doesn't end in _bench")
+    else:
+        await server.client.drop_database(os.environ["DB_NAME"])
+        await server.ensure_indexes()
+
+    server.LlmChat = FakeLlmChat
+    server.payments_client._checkout = FakeStripeCheckout()
+
+    # ai_turn goes through the session queues; resolve each message once its turn is answered
+    handle_ai_turn = server.handle_ai_turn
+
+    async def answered_turn(messages):
+        try:
+            await handle_ai_turn(messages)
+        finally:
+            for message in messages:
+                if message.answered is not None and not message.answered.done():
+                    message.answered.set_result(None)
+    server.handle_ai_turn = answered_turn
+
+    async def no_commands(message):
+        return None
+    server.bot.process_commands = no_commands
+
+    await server.db.bot_configs.insert_one(server.BotConfig(
+        guild_id=str(GUILD_ID), ai_channel_id=str(AI_CHANNEL_ID)
+    ).dict())
+    products = [server.Product(name=f"Produto {i}", price=10 + i, description="Bench", stock=10 ** 6).dict() for i in range(50)]
+    await server.db.products.insert_many(products)
+    await server.catalog_changed()
+    server.conversation_sink.start()
+    return [product["id"] for product in products]
+
+# Scenarios
+async def build_scenarios(server, product_ids, selected):
+    import httpx
+    http = httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://bench")
+    ai_channel = FakeChannel(AI_CHANNEL_ID)
+    # Streamed edits are throttled per channel, so AI turns are spread over several
+    ai_channels = [FakeChannel(AI_CHANNEL_ID + 100 + i) for i in range(AI_BENCH_CHANNELS)]
+    other_channel = FakeChannel(OTHER_CHANNEL_ID)
+    sessions = []  # consumed by webhook
+    status_sessions = []  # polled by payment_status, never completed
+    counter = {"n": 0}
+
+    def next_n():
+        counter["n"] += 1
+        return counter["n"]
+
+    async def on_message():
+        await server.on_message(FakeMessage("conversa fora do canal de IA", next_n() % 500, other_channel))
+
+    async def ai_turn():
+        n = next_n()
+        # A mix of repeated questions (cacheable) and unique ones
+        content = "quais produtos vocês têm?" if n % 3 == 0 else f"pergunta {n}"
+        message = FakeMessage(content, n % 200, ai_channels[n % AI_BENCH_CHANNELS])
+        message.answered = asyncio.get_running_loop().create_future()
+        await server.process_ai_message(message)
+        await message.answered
+
+    async def product_listing():
+        await server.handle_product_listing(FakeMessage("!produtos", next_n(), ai_channel))
+
+    async def add_product():
+        n = next_n()
+        await server.add_product_command.callback(FakeContext(ai_channel, n), f"Bench{n}", 9.9, resto="desc bench 5")
+
+    async def create_session():
+        response = await http.post("/api/payments/checkout", json={
+            "product_id": product_ids[next_n() % len(product_ids)],
+            "discord_user_id": "123",
+            "origin_url": "http://bench"
+        })
+        response.raise_for_status()
+        return response.json()["session_id"]
+
+    async def checkout():
+        sessions.append(await create_session())
+
+    async def webhook():
+        session_id = sessions.pop() if sessions else f"cs_missing_{next_n()}"
+        payload, signature = signed_stripe_event(session_id)
+        response = await http.post("/api/webhook/stripe", content=payload, headers={"Stripe-Signature": signature})
+        response.raise_for_status()
+
+    async def payment_status():
+        session_id = status_sessions[next_n() % len(status_sessions)]
+        response = await http.get(f"/api/payments/status/{session_id}")
+        response.raise_for_status()
+
+    # payment_status gets its own open sessions, so it measures the lookup of
+    # a real transaction whatever webhook has already completed
+    if "payment_status" in selected:
+        for _ in range(BENCH_STATUS_SESSIONS):
+            status_sessions.append(await create_session())
+
+    return {
+        "on_message": on_message,
+        "ai_turn": ai_turn,
+        "product_listing": product_listing,
+        "add_product": add_product,
+        "checkout": checkout,
+        "webhook": webhook,
+        "payment_status": payment_status,
+    }
+
+async def run_scenario(name, call, rate, duration):
+    """Open-loop load: start one call every 1/rate seconds, regardless of completions"""
+    latencies = []
+    errors = []
+
+    async def timed():
+        started = time.perf_counter()
+        try:
+            await call()
+            latencies.append(time.perf_counter() - started)
+        except Exception as e:
+            errors.append(repr(e))
+
+    memory_before = tracemalloc.get_traced_memory()[0]
+    tasks = []
+    started = time.perf_counter()
+    for i in range(int(rate * duration)):
+        delay = started + i / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(timed()))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    memory_after = tracemalloc.get_traced_memory()[0]
+
+    latencies.sort()
+
+    def percentile(p):
+        if not latencies:
+            return None
+        return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 2)
+
+    result = {
+        "requests": len(tasks),
+        "errors": len(errors),
+        "throughput": round(len(latencies) / elapsed, 1),
+        "p50_ms": percentile(0.50),
+        "p99_ms": percentile(0.99),
+        "memory_growth_kb": round((memory_after - memory_before) / 1024, 1),
+    }
+    if errors:
+        result["first_error"] = errors[0]
+    return result
+
+def compare_with_baseline(results, tolerance):
+    baseline = json.loads(BASELINE_FILE.read_text())
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if not reference or not reference.get("p99_ms") or result.get("p99_ms") is None:
+            continue
+        if result["p99_ms"] > reference["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {result['p99_ms']}ms vs baseline {reference['p99_ms']}ms")
+    return regressions
+
+async def main(args):
+    import server
+
+    FakeLlmChat.latency = args.llm_latency
+    FakeChannel.latency = args.discord_latency
+    FakeStripeCheckout.latency = args.stripe_latency
+
+    tracemalloc.start()
+    product_ids = await setup(server, args.mongo)
+    selected = args.scenario or SCENARIOS
+    scenarios = await build_scenarios(server, product_ids, selected)
+
+    results = {}
+    for name in selected:
+        print(f"\n=== {name}: {args.rate} req/s for {args.duration}s ===")
+        results[name] = await run_scenario(name, scenarios[name], args.rate, args.duration)
+        print(json.dumps(results[name], indent=2))
+
+    await server.conversation_sink.close()
+    tracemalloc.stop()
+
+    print("\n=== Summary ===")
+    print(f"{'scenario':<18}{'p50 ms':>10}{'p99 ms':>10}{'req/s':>10}{'errors':>8}{'mem KB':>10}")
+    for name, result in results.items():
+        print(f"{name:<18}{str(result['p50_ms']):>10}{str(result['p99_ms']):>10}"
+              f"{result['throughput']:>10}{result['errors']:>8}{result['memory_growth_kb']:>10}")
+
+    if args.save_baseline:
+        BASELINE_FILE.write_text(json.dumps(results, indent=2))
+        print(f"\nBaseline saved to {BASELINE_FILE}")
+    if args.baseline:
+        regressions = compare_with_baseline(results, args.tolerance)
+        if regressions:
+            print("\nRegressions:")
+            for regression in regressions:
+                print(f"  - {regression}")
+            return 1
+        print("\nNo p99 regressions against baseline")
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS,
+                        help="scenario to run (repeatable; default: all)")
+    parser.add_argument("--rate", type=float, default=50, help="arrivals per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per scenario")
+    parser.add_argument("--llm-latency", type=float, default=0.2)
+    parser.add_argument("--discord-latency", type=float, default=0.02)
+    parser.add_argument("--stripe-latency", type=float, default=0.1)
+    parser.add_argument("--mongo", choices=["local", "mock"], default="local",
+                        help="local mongod (MONGO_URL) or mongomock-motor")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--baseline", action="store_true", help="compare p99 against bench_baseline.json")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed p99 regression (0.2 = 20%%)")
+    sys.exit(asyncio.run(main(parser.parse_args())))
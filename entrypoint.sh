@@ -5,8 +5,16 @@ set -e
 cd /backend || { echo "Backend directory not found"; exit 1; }
 
 echo "Starting FastAPI backend"
-# Start Uvicorn with proper host binding
-uvicorn server:app --host 0.0.0.0 --port 8001 &
+WORKER_PID=""
+if [ "$BOT_MODE" = "api" ]; then
+    # Split mode: one Discord bot worker, several stateless API workers
+    python bot_worker.py &
+    WORKER_PID=$!
+    uvicorn server:app --host 0.0.0.0 --port 8001 --workers "${API_WORKERS:-2}" &
+else
+    # Start Uvicorn with proper host binding
+    uvicorn server:app --host 0.0.0.0 --port 8001 &
+fi
 BACKEND_PID=$!
 
 echo "Waiting for backend to start..."
@@ -22,14 +30,16 @@ nginx -g 'daemon off;' &
 NGINX_PID=$!
 
 # Handle termination signals
-trap 'kill $BACKEND_PID $NGINX_PID; exit 0' SIGTERM SIGINT
+trap 'kill $BACKEND_PID $NGINX_PID $WORKER_PID; exit 0' SIGTERM SIGINT
 
 # Check if processes are still running
-while kill -0 $BACKEND_PID 2>/dev/null && kill -0 $NGINX_PID 2>/dev/null; do
+while kill -0 $BACKEND_PID 2>/dev/null && kill -0 $NGINX_PID 2>/dev/null \
+    && { [ -z "$WORKER_PID" ] || kill -0 $WORKER_PID 2>/dev/null; }; do
     sleep 1
 done
 
 # If we get here, one of the processes died
+[ -n "$WORKER_PID" ] && kill $WORKER_PID 2>/dev/null
 if kill -0 $BACKEND_PID 2>/dev/null; then
     echo "Nginx died, shutting down backend..."
     kill $BACKEND_PID
@@ -211,6 +211,8 @@ const Dashboard = () => {
   const [products, setProducts] = useState([]);
   const [conversations, setConversations] = useState([]);
   const [transactions, setTransactions] = useState([]);
+  const [conversationsCursor, setConversationsCursor] = useState(null);
+  const [transactionsCursor, setTransactionsCursor] = useState(null);
   const [loading, setLoading] = useState(false);
   const [paymentLoading, setPaymentLoading] = useState(false);
   const [newProduct, setNewProduct] = useState({
@@ -229,6 +231,28 @@ const Dashboard = () => {
     
     // Check for payment return
     checkPaymentReturn();
+
+    // Live updates instead of refetching whole lists
+    const events = new EventSource(`${API}/events`);
+    events.addEventListener('bot', (e) => setBotStatus(JSON.parse(e.data)));
+    events.addEventListener('product', () => fetchProducts());
+    events.addEventListener('conversation', (e) => {
+      const conversation = JSON.parse(e.data);
+      setConversations((current) => [conversation, ...current.filter((c) => c.id !== conversation.id)]);
+    });
+    events.addEventListener('transaction', (e) => {
+      const change = JSON.parse(e.data);
+      setTransactions((current) => {
+        const index = current.findIndex((t) => t.session_id === change.session_id);
+        if (index === -1) {
+          return change.id ? [change, ...current] : current;
+        }
+        const updated = [...current];
+        updated[index] = { ...updated[index], ...change };
+        return updated;
+      });
+    });
+    return () => events.close();
   }, []);
 
   const checkPaymentReturn = () => {
@@ -244,7 +268,7 @@ const Dashboard = () => {
   };
 
   const pollPaymentStatus = async (sessionId, attempts = 0) => {
-    const maxAttempts = 5;
+    const maxAttempts = 15; // status is a DB read now; confirmation arrives via webhook
     const pollInterval = 2000;
 
     if (attempts >= maxAttempts) {
@@ -275,10 +299,13 @@ const Dashboard = () => {
     }
   };
 
-  const fetchTransactions = async () => {
+  const fetchTransactions = async (after = null) => {
     try {
-      const response = await axios.get(`${API}/payments/transactions`);
-      setTransactions(response.data);
+      const response = await axios.get(`${API}/payments/transactions`, {
+        params: after ? { after } : {}
+      });
+      setTransactions((current) => (after ? [...current, ...response.data] : response.data));
+      setTransactionsCursor(response.headers['x-next-cursor'] || null);
     } catch (error) {
       console.error("Erro ao buscar transações:", error);
     }
@@ -329,10 +356,13 @@ const Dashboard = () => {
     }
   };
 
-  const fetchConversations = async () => {
+  const fetchConversations = async (after = null) => {
     try {
-      const response = await axios.get(`${API}/conversations`);
-      setConversations(response.data);
+      const response = await axios.get(`${API}/conversations`, {
+        params: after ? { after } : {}
+      });
+      setConversations((current) => (after ? [...current, ...response.data] : response.data));
+      setConversationsCursor(response.headers['x-next-cursor'] || null);
     } catch (error) {
       console.error("Erro ao buscar conversas:", error);
     }
@@ -555,9 +585,17 @@ const Dashboard = () => {
                 </div>
               ))
             )}
+            {conversationsCursor && (
+              <button
+                onClick={() => fetchConversations(conversationsCursor)}
+                className="w-full text-blue-600 hover:text-blue-800 py-2 text-sm"
+              >
+                Carregar mais
+              </button>
+            )}
           </div>
           <button
-            onClick={fetchConversations}
+            onClick={() => fetchConversations()}
             className="mt-4 w-full bg-blue-500 hover:bg-blue-600 text-white py-2 rounded-lg"
           >
             🔄 Atualizar Conversas
@@ -609,9 +647,17 @@ const Dashboard = () => {
               </div>
             ))
           )}
+          {transactionsCursor && (
+            <button
+              onClick={() => fetchTransactions(transactionsCursor)}
+              className="w-full text-purple-600 hover:text-purple-800 py-2 text-sm"
+            >
+              Carregar mais
+            </button>
+          )}
         </div>
         <button
-          onClick={fetchTransactions}
+          onClick={() => fetchTransactions()}
           className="mt-4 w-full bg-purple-500 hover:bg-purple-600 text-white py-2 rounded-lg"
         >
           🔄 Atualizar Transações
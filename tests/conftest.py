@@ -0,0 +1,33 @@
+import os
+import sys
+from pathlib import Path
+
+# server.py lives in backend/ and reads its Mongo settings at import time;
+# the client connects lazily, so unit tests don't need a running mongod.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))  # shared fakes
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "discord_bot_test")
+
+import pytest
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    """server.db swapped for an empty in-memory database (mongomock-motor)"""
+    server = pytest.importorskip("server")
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    database = mongomock_motor.AsyncMongoMockClient()["discord_bot_test"]
+    monkeypatch.setattr(server, "db", database)
+    return database
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """server's time.monotonic, advanced by hand through clock.now"""
+    server = pytest.importorskip("server")
+    from fakes import FakeClock
+
+    clock = FakeClock()
+    monkeypatch.setattr(server.time, "monotonic", clock)
+    return clock
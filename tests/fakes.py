@@ -0,0 +1,91 @@
+"""Minimal stand-ins for discord.py and LlmChat objects used by the tests"""
+import asyncio
+import itertools
+
+_ids = itertools.count(1)
+
+
+class FakeSentMessage:
+    def __init__(self, channel, content):
+        self.channel = channel
+        self.content = content
+        self.deleted = False
+
+    async def edit(self, content=None, **kwargs):
+        self.channel.edits.append(content)
+        self.content = content
+
+    async def delete(self):
+        self.deleted = True
+
+
+class FakeChannel:
+    def __init__(self, channel_id=None, fail_sends=False):
+        self.id = channel_id or next(_ids)
+        self.fail_sends = fail_sends
+        self.sent = []
+        self.edits = []
+
+    async def send(self, content=None, **kwargs):
+        if self.fail_sends:
+            raise RuntimeError("403 Forbidden")
+        message = FakeSentMessage(self, content)
+        self.sent.append(message)
+        return message
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.bot = False
+        self.mention = f"<@{user_id}>"
+
+
+class FakeGuild:
+    def __init__(self, guild_id=1000):
+        self.id = guild_id
+
+
+class FakeMessage:
+    def __init__(self, content, user_id=1, channel=None, guild=None):
+        self.id = next(_ids)
+        self.content = content
+        self.author = FakeUser(user_id)
+        self.channel = channel or FakeChannel()
+        self.guild = guild or FakeGuild()
+
+
+class FakeLlmChat:
+    """LlmChat that streams a canned answer in a few chunks"""
+    answer = "Resposta simulada"
+    chunks = 4
+    delay = 0.0
+    prompts = []
+
+    def __init__(self, api_key=None, session_id=None, system_message=None, initial_messages=None):
+        self.system_message = system_message
+        self.initial_messages = initial_messages or []
+
+    def with_model(self, provider, model):
+        return self
+
+    async def send_message(self, user_message):
+        self.prompts.append(user_message.text)
+        return self.answer
+
+    async def stream_message(self, user_message):
+        self.prompts.append(user_message.text)
+        step = max(1, len(self.answer) // self.chunks)
+        for i in range(0, len(self.answer), step):
+            await asyncio.sleep(self.delay)
+            yield self.answer[i:i + step]
+
+
+class FakeClock:
+    """Settable stand-in for time.monotonic"""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
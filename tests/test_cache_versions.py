@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+
+server = pytest.importorskip("server")
+
+
+@pytest.fixture
+def caches(mongo, monkeypatch):
+    monkeypatch.setattr(server, "seen_cache_versions", {})
+    monkeypatch.setattr(server, "ai_response_cache", server.ResponseCache(max_entries=10, ttl=60))
+    monkeypatch.setattr(server, "guild_config_cache", server.OrderedDict())
+    monkeypatch.setattr(server, "catalog_snapshot", server.CatalogSnapshot(60, server.ProductIndex()))
+    server.ai_response_cache.put("oi", "Olá!")
+    server.cache_guild_config("1", {"guild_id": "1", "ai_enabled": True})
+    return mongo
+
+
+async def bump_elsewhere(mongo, name):
+    """What another process' bump_cache_version leaves in Mongo"""
+    await mongo.cache_versions.update_one({"_id": name}, {"$inc": {"version": 1}}, upsert=True)
+
+
+def test_other_process_writes_invalidate_local_caches(caches):
+    async def scenario():
+        await server.check_cache_versions()
+        version = server.catalog_snapshot.version
+        for name in ("catalog", "catalog_answers", "guild_configs"):
+            await bump_elsewhere(caches, name)
+        await server.check_cache_versions()
+        return server.catalog_snapshot.version > version
+
+    assert asyncio.run(scenario())
+    assert server.ai_response_cache.get("oi") is None
+    assert "1" not in server.guild_config_cache
+
+
+def test_own_writes_are_not_invalidated_twice(caches):
+    async def scenario():
+        await server.check_cache_versions()
+        await server.bump_cache_version("catalog_answers")
+        await server.bump_cache_version("guild_configs")
+        await server.check_cache_versions()
+
+    asyncio.run(scenario())
+    assert server.ai_response_cache.get("oi") == "Olá!"
+    assert "1" in server.guild_config_cache
+
+
+def test_first_counter_created_elsewhere_is_applied(caches):
+    async def scenario():
+        await server.check_cache_versions()  # no counters yet
+        await bump_elsewhere(caches, "guild_configs")
+        await server.check_cache_versions()
+
+    asyncio.run(scenario())
+    assert "1" not in server.guild_config_cache
+
+
+def restock(mongo, stock):
+    async def scenario():
+        await server.check_cache_versions()
+        server.catalog_snapshot.apply({"id": "p1", "name": "Netflix", "price": 30.0, "stock": 3})
+        await server.catalog_changed({"id": "p1", "name": "Netflix", "price": 30.0, "stock": stock}, stock_only=True)
+        return {doc["_id"]: doc["version"] async for doc in mongo.cache_versions.find()}
+
+    return asyncio.run(scenario())
+
+
+def test_stock_changes_leave_answers_to_other_processes(caches):
+    assert restock(caches, 2) == {"catalog": 1}
+    assert server.ai_response_cache.get("oi") == "Olá!"
+
+
+def test_selling_out_invalidates_answers_everywhere(caches):
+    assert restock(caches, 0) == {"catalog": 1, "catalog_answers": 1}
+    assert server.ai_response_cache.get("oi") is None
@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+from fakes import FakeLlmChat
+
+server = pytest.importorskip("server")
+
+
+@pytest.fixture
+def llm(mongo, monkeypatch):
+    class Chat(FakeLlmChat):
+        answer = "Resumo: cliente quer Netflix"
+        prompts = []
+
+    monkeypatch.setattr(server, "LlmChat", Chat)
+    monkeypatch.setattr(server, "AI_CONTEXT_WINDOW_TURNS", 2)
+    monkeypatch.setattr(server, "AI_CONTEXT_SUMMARY_BATCH", 1)
+    return Chat
+
+
+def turns(*numbers):
+    return [(f"pergunta {n}", f"resposta {n}") for n in numbers]
+
+
+def test_prepare_sends_the_window_and_summary(llm):
+    context = server.ChatContext("s1", turns(0, 1, 2), summary="cliente quer Netflix")
+    chat, content = context.prepare("e o preço?")
+    assert content == "e o preço?"
+    assert [message["content"] for message in chat.initial_messages] == ["pergunta 1", "resposta 1", "pergunta 2", "resposta 2"]
+    assert "cliente quer Netflix" in chat.system_message
+
+
+def test_prepare_drops_turns_past_the_token_budget(llm, monkeypatch):
+    monkeypatch.setattr(server, "AI_CONTEXT_TOKEN_BUDGET", server.estimate_tokens(server.AI_SYSTEM_MESSAGE) + 20)
+    context = server.ChatContext("s1", [("a " * 30, "b " * 30), ("oi", "olá")])
+    chat, _ = context.prepare("tudo bem?")
+    assert [message["content"] for message in chat.initial_messages] == ["oi", "olá"]
+
+
+def summarized(context, mongo, *recorded):
+    async def scenario():
+        for user_text, assistant_text in recorded:
+            context.record(user_text, assistant_text)
+        await context._summarizing
+        return await mongo.conversation_memories.find_one({"session_id": context.session_id})
+
+    return asyncio.run(scenario())
+
+
+def test_turns_leaving_the_window_are_summarized(llm, mongo):
+    context = server.ChatContext("s1", turns(0, 1))
+    memory = summarized(context, mongo, *turns(2))
+    assert context.turns == turns(1, 2)
+    assert context.summary == memory["summary"] == llm.answer
+    assert "pergunta 0" in llm.prompts[0] and "pergunta 1" not in llm.prompts[0]
+
+
+def test_overflow_trim_leaves_the_window_alone(llm, mongo):
+    # Earlier summaries failed: 4 batches past the window are already waiting
+    context = server.ChatContext("s1", turns(*range(7)))
+    summarized(context, mongo, *turns(7))
+    assert context.turns == turns(6, 7)
+    assert "pergunta 2" in llm.prompts[0] and "pergunta 5" in llm.prompts[0]
+    assert "pergunta 1" not in llm.prompts[0] and "pergunta 6" not in llm.prompts[0]
@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+
+server = pytest.importorskip("server")
+
+
+@pytest.fixture
+def worker_env(mongo, monkeypatch):
+    monkeypatch.setattr(server.bot, "is_ready", lambda: True)
+    monkeypatch.setattr(server, "DELIVERY_POLL_INTERVAL", 0.01)
+    monkeypatch.setattr(server, "DELIVERY_CLAIM_BATCH", 1)
+    monkeypatch.setattr(server, "delivery_wakeup", asyncio.Event())
+    delivered = []
+
+    async def deliver(transaction):
+        delivered.append(transaction["session_id"])
+        return True
+
+    monkeypatch.setattr(server, "deliver_product_to_user", deliver)
+    return delivered
+
+
+async def queue_paid(mongo, session_id):
+    await mongo.payment_transactions.insert_one(server.PaymentTransaction(
+        session_id=session_id, product_id="p1", discord_user_id="42", amount=10.0, payment_status="paid"
+    ).dict())
+    await server.enqueue_delivery(session_id)
+
+
+async def run_worker(seconds=0.3):
+    task = asyncio.create_task(server.delivery_worker())
+    await asyncio.sleep(seconds)
+    alive = not task.done()
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    return alive
+
+
+def test_worker_survives_a_failing_lease_renewal(mongo, worker_env, monkeypatch):
+    renew = server.renew_delivery_lease
+    calls = []
+
+    async def flaky_renew(job):
+        calls.append(job["session_id"])
+        if len(calls) == 1:
+            raise ConnectionError("mongo indisponível")
+        return await renew(job)
+
+    monkeypatch.setattr(server, "renew_delivery_lease", flaky_renew)
+
+    async def scenario():
+        await queue_paid(mongo, "cs_1")
+        await queue_paid(mongo, "cs_2")
+        alive = await run_worker()
+        jobs = {job["session_id"]: job async for job in mongo.delivery_jobs.find()}
+        return alive, jobs
+
+    alive, jobs = asyncio.run(scenario())
+    assert alive
+    failed = calls[0]
+    delivered = "cs_2" if failed == "cs_1" else "cs_1"
+    assert worker_env == [delivered]
+    assert jobs[delivered]["status"] == "done"
+    # The failed job keeps its lease and is retried once it expires
+    assert jobs[failed]["status"] == "running"
+
+
+def test_worker_survives_a_failing_user_lookup(mongo, worker_env, monkeypatch):
+    monkeypatch.setattr(server, "DELIVERY_CLAIM_BATCH", 10)
+
+    async def broken_fetch(user_id):
+        raise RuntimeError("falha inesperada")
+
+    monkeypatch.setattr(server.bot, "fetch_user", broken_fetch)
+
+    async def scenario():
+        await queue_paid(mongo, "cs_1")
+        await queue_paid(mongo, "cs_2")
+        return await run_worker()
+
+    assert asyncio.run(scenario())
+    assert sorted(worker_env) == ["cs_1", "cs_2"]
@@ -0,0 +1,34 @@
+import asyncio
+
+import pytest
+
+server = pytest.importorskip("server")
+
+
+def drain(queue):
+    events = []
+    while not queue.empty():
+        events.append(queue.get_nowait())
+    return events
+
+
+def test_product_bursts_are_sent_as_one_event():
+    hub = server.EventHub(queue_size=100, coalesce_interval=0.02)
+    queue = asyncio.Queue()
+    hub.subscribers.add(queue)
+
+    async def scenario():
+        for stock in range(50):
+            hub.publish("product", {"id": "p1", "stock": stock})
+        hub.publish("transaction", {"session_id": "cs_1"})
+        before = drain(queue)
+        await asyncio.sleep(0.05)
+        after = drain(queue)
+        hub.publish("product", {"id": "p1"})
+        await asyncio.sleep(0.05)
+        return before, after, drain(queue)
+
+    before, after, later = asyncio.run(scenario())
+    assert before == [("transaction", {"session_id": "cs_1"})]
+    assert after == [("product", {})]
+    assert later == [("product", {})]
@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+
+server = pytest.importorskip("server")
+
+
+@pytest.fixture
+def configs(mongo, monkeypatch):
+    monkeypatch.setattr(server, "guild_config_cache", server.OrderedDict())
+    monkeypatch.setattr(server, "seen_cache_versions", {})
+    asyncio.run(mongo.bot_configs.insert_one({"guild_id": "1", "ai_enabled": True}))
+    return mongo
+
+
+def ai_enabled(guild_id="1"):
+    config = asyncio.run(server.get_bot_config(guild_id))
+    return config and config["ai_enabled"]
+
+
+def write_elsewhere(mongo, enabled):
+    """A write this process' cache doesn't know about"""
+    asyncio.run(mongo.bot_configs.update_one({"guild_id": "1"}, {"$set": {"ai_enabled": enabled}}))
+
+
+def test_configs_are_served_from_cache(configs):
+    assert ai_enabled()
+    write_elsewhere(configs, False)
+    assert ai_enabled()
+
+
+def test_missing_configs_are_cached_too(configs):
+    assert ai_enabled("2") is None
+    assert "2" in server.guild_config_cache
+
+
+def test_update_invalidates_cached_config(configs):
+    assert ai_enabled()
+    asyncio.run(server.update_guild_config("1", {"ai_enabled": False}))
+    assert not ai_enabled()
+
+
+def test_cached_configs_expire(configs, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(server.time, "monotonic", lambda: now[0])
+    assert ai_enabled()
+    write_elsewhere(configs, False)
+    now[0] += server.GUILD_CONFIG_CACHE_TTL + 1
+    assert not ai_enabled()
+
+
+def test_least_recently_used_config_is_evicted(configs, monkeypatch):
+    monkeypatch.setattr(server, "GUILD_CONFIG_CACHE_MAX", 2)
+    for guild_id in ("1", "2", "1", "3"):
+        asyncio.run(server.get_bot_config(guild_id))
+    assert list(server.guild_config_cache) == ["1", "3"]
+
+
+def test_polling_refreshes_cached_configs(configs, monkeypatch):
+    monkeypatch.setattr(server, "GUILD_CONFIG_POLL_INTERVAL", 0.01)
+
+    async def scenario():
+        await server.get_bot_config("1")
+        await configs.bot_configs.update_one({"guild_id": "1"}, {"$set": {"ai_enabled": False}})
+        watcher = asyncio.create_task(server.watch_guild_configs())  # no change streams in mongomock
+        await asyncio.sleep(0.05)
+        watcher.cancel()
+        return (await server.get_bot_config("1"))["ai_enabled"]
+
+    assert asyncio.run(scenario()) is False
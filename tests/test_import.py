@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+server = pytest.importorskip("server")
+
+
+def rows(lines, fmt="csv"):
+    async def source():
+        for line in lines:
+            yield line
+
+    async def collect():
+        return [row async for row in server.iter_import_rows(source(), fmt)]
+
+    return asyncio.run(collect())
+
+
+def test_csv_rows_are_keyed_by_lowercased_header():
+    assert rows(["SKU, Name ,price", "nf-1,Netflix,30", "", "sp-1,Spotify,20"]) == [
+        (1, {"sku": "nf-1", "name": "Netflix", "price": "30"}),
+        (3, {"sku": "sp-1", "name": "Spotify", "price": "20"}),
+    ]
+
+
+def test_csv_quoted_field_may_span_lines():
+    assert rows(['sku,description', 'a,"linha 1', 'linha 2, com ""aspas"""', "b,x"]) == [
+        (1, {"sku": "a", "description": 'linha 1\nlinha 2, com "aspas"'}),
+        (2, {"sku": "b", "description": "x"}),
+    ]
+
+
+def test_csv_unclosed_quote_at_end_is_reported():
+    assert rows(["sku,name", 'a,"Netflix']) == [(1, "Aspas não fechadas no fim do arquivo")]
+
+
+def test_csv_stray_quote_fails_one_row_and_resyncs(monkeypatch):
+    monkeypatch.setattr(server, "PRODUCT_IMPORT_MAX_RECORD_LINES", 3)
+    result = rows(["sku,name", 'a,"Netflix', "b,Spotify", "c,Disney", "d,Max", "e,Prime"])
+    assert result[0] == (1, "Registro grande demais ou aspas não fechadas")
+    assert [record["sku"] for _, record in result[1:]] == ["b", "c", "d", "e"]
+
+
+def test_csv_oversized_record_is_reported(monkeypatch):
+    monkeypatch.setattr(server, "PRODUCT_IMPORT_MAX_RECORD_SIZE", 50)
+    result = rows(["sku,description", 'a,"' + "x" * 30, "y" * 30 + '"', "b,ok"])
+    assert result[0][1] == "Registro grande demais ou aspas não fechadas"
+    assert result[-1] == (2, {"sku": "b", "description": "ok"})
+
+
+def test_ndjson_rows_and_errors():
+    result = rows(['{"sku": "a"}', "", "[1]", "{oops"], fmt="ndjson")
+    assert result[:2] == [(1, {"sku": "a"}), (3, "A linha deve ser um objeto JSON")]
+    assert result[2][0] == 4
+    assert result[2][1].startswith("JSON inválido")
+
+
+def test_ndjson_oversized_line_is_reported(monkeypatch):
+    monkeypatch.setattr(server, "PRODUCT_IMPORT_MAX_RECORD_SIZE", 20)
+    assert rows(['{"sku": "' + "a" * 30 + '"}'], fmt="ndjson") == [(1, "Linha grande demais")]
@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+from fakes import FakeChannel, FakeMessage
+
+server = pytest.importorskip("server")
+
+
+@pytest.mark.parametrize("text, intent", [
+    ("listar produtos", "list_products"),
+    ("Mostre todos os produtos!", "list_products"),
+    ("quais são os produtos disponíveis?", "list_products"),
+    ("catálogo", "list_products"),
+    ("ver o catálogo", "list_products"),
+    ("quero adicionar um produto", "add_product"),
+    ("ajuda", "help"),
+    ("quais os comandos?", "help"),
+    ("Preciso de ajuda", "help"),
+    ("Olá, tudo bem?", "greeting"),
+    ("oii galera", "greeting"),
+])
+def test_commands_are_routed(text, intent):
+    assert server.classify_intent(text) == intent
+
+
+@pytest.mark.parametrize("text", [
+    "o catálogo tem spotify?",
+    "quero ver produtos de streaming baratos",
+    "preciso de ajuda com meu pedido",
+    "oi, qual o preço da netflix?",
+    "quais produtos de música vocês têm?",
+])
+def test_questions_go_to_the_llm(text):
+    assert server.classify_intent(text) is None
+
+
+@pytest.fixture
+def turn(monkeypatch):
+    """Run handle_ai_turn recording routed intents and what reached the LLM"""
+    monkeypatch.setattr(server, "AI_STREAM_REPLIES", False)
+    routed, asked = [], []
+
+    async def handle_intent(intent, message):
+        routed.append((intent, message.content))
+        return intent
+
+    async def ask_llm(session_id, content, reply=None):
+        asked.append(content)
+        return "resposta"
+
+    async def get_chat_context(session_id):
+        return server.ChatContext(session_id)
+
+    async def add(document):
+        pass
+
+    monkeypatch.setattr(server, "handle_intent", handle_intent)
+    monkeypatch.setattr(server, "ask_llm", ask_llm)
+    monkeypatch.setattr(server, "get_chat_context", get_chat_context)
+    monkeypatch.setattr(server.conversation_sink, "add", add)
+
+    def run(*contents):
+        channel = FakeChannel()
+        asyncio.run(server.handle_ai_turn([FakeMessage(content, channel=channel) for content in contents]))
+        return routed, asked, [sent.content for sent in channel.sent]
+
+    return run
+
+
+def test_coalesced_command_keeps_the_question(turn):
+    routed, asked, sent = turn("listar produtos", "qual o preço da netflix?")
+    assert routed == [("list_products", "listar produtos")]
+    assert asked == ["qual o preço da netflix?"]
+    assert sent == ["resposta"]
+
+
+def test_greeting_next_to_a_question_is_left_to_the_llm(turn):
+    routed, asked, _ = turn("oi", "tem spotify?")
+    assert routed == []
+    assert asked == ["oi\ntem spotify?"]
+
+
+def test_batch_of_commands_skips_the_llm(turn):
+    routed, asked, _ = turn("oi", "oi", "ajuda")
+    assert routed == [("greeting", "oi"), ("help", "ajuda")]
+    assert asked == []
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+from fakes import FakeChannel, FakeLlmChat, FakeMessage
+
+server = pytest.importorskip("server")
+
+
+def test_short_text_is_one_part():
+    assert server.split_discord_message("Olá!") == ["Olá!"]
+
+
+def test_blank_text_has_no_parts():
+    assert server.split_discord_message("  \n ") == []
+
+
+def test_split_prefers_line_breaks():
+    text = "a" * 15 + "\n" + "b" * 15
+    assert server.split_discord_message(text, limit=20) == ["a" * 15, "b" * 15]
+
+
+def test_split_falls_back_to_spaces_then_hard_cut():
+    assert server.split_discord_message("aaaa bbbb cccc", limit=10) == ["aaaa bbbb", " cccc"]
+    assert server.split_discord_message("x" * 25, limit=10) == ["x" * 10, "x" * 10, "x" * 5]
+
+
+def test_parts_respect_limit_and_keep_content():
+    text = "\n".join(f"linha {i} " + "palavra " * (i % 7) for i in range(200))
+    parts = server.split_discord_message(text)
+    assert all(len(part) <= server.DISCORD_MESSAGE_LIMIT for part in parts)
+    assert "".join(parts).replace("\n", "") == text.replace("\n", "")
+
+
+def test_earlier_parts_are_stable_while_text_grows():
+    text = "\n".join(f"linha {i}" for i in range(100))
+    before = server.split_discord_message(text, limit=100)
+    after = server.split_discord_message(text + "\nmais uma linha", limit=100)
+    assert after[:len(before) - 1] == before[:-1]
+
+
+# Streamed replies (handle_ai_turn with a streaming LLM)
+
+@pytest.fixture
+def llm(mongo, monkeypatch):
+    class Chat(FakeLlmChat):
+        answer = "\n".join(f"linha {i} da resposta" for i in range(150))  # over one message
+        chunks = 6
+        delay = 0.01
+        prompts = []
+
+    monkeypatch.setattr(server, "LlmChat", Chat)
+    monkeypatch.setattr(server, "AI_STREAM_REPLIES", True)
+    monkeypatch.setattr(server, "AI_STREAM_EDIT_INTERVAL", 0.005)
+    monkeypatch.setattr(server, "ai_response_cache", server.ResponseCache(max_entries=10, ttl=60))
+    logged = []
+
+    async def add(document):
+        logged.append(document)
+
+    monkeypatch.setattr(server.conversation_sink, "add", add)
+    return Chat, logged
+
+
+def test_reply_is_streamed_into_a_placeholder(llm):
+    Chat, logged = llm
+    channel = FakeChannel()
+    asyncio.run(server.handle_ai_turn([FakeMessage("me fale sobre a loja", channel=channel)]))
+
+    assert channel.sent[0].content != server.AI_STREAM_PLACEHOLDER
+    assert channel.edits[0] != Chat.answer  # partial text was shown before the end
+    assert [sent.content for sent in channel.sent] == server.split_discord_message(Chat.answer)
+    assert not any(sent.deleted for sent in channel.sent)
+    assert Chat.prompts == ["me fale sobre a loja"]
+    assert logged[0]["ai_response"] == Chat.answer
+
+
+def test_failed_stream_falls_back_in_the_same_messages(llm, monkeypatch):
+    Chat, _ = llm
+
+    async def broken(self, user_message):
+        yield "começo da resp"
+        raise ConnectionError("stream interrompido")
+
+    monkeypatch.setattr(Chat, "stream_message", broken)
+    channel = FakeChannel()
+    asyncio.run(server.handle_ai_turn([FakeMessage("me fale sobre a loja", channel=channel)]))
+
+    shown = [sent.content for sent in channel.sent if not sent.deleted]
+    assert len(shown) == 1
+    assert "indisponível" in shown[0]
@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+
+server = pytest.importorskip("server")
+from starlette.requests import Request
+from starlette.responses import StreamingResponse
+
+
+def request():
+    return Request({"type": "http", "method": "GET", "path": "/api/products", "headers": [], "query_string": b""})
+
+
+def timed(monkeypatch, media_type):
+    """Run the latency middleware over a body that takes 50 ms to stream"""
+    observed = []
+    monkeypatch.setattr(server, "observe", lambda name, seconds, **labels: observed.append((name, seconds, labels)))
+
+    async def chunks():
+        for _ in range(5):
+            await asyncio.sleep(0.01)
+            yield b"[]"
+
+    async def call_next(request):
+        return StreamingResponse(chunks(), media_type=media_type)
+
+    async def scenario():
+        response = await server.record_request_latency(request(), call_next)
+        at_headers = list(observed)
+        async for _ in response.body_iterator:
+            pass
+        return at_headers
+
+    return asyncio.run(scenario()), observed
+
+
+def test_streamed_responses_are_timed_until_the_last_chunk(monkeypatch):
+    at_headers, observed = timed(monkeypatch, "application/json")
+    assert at_headers == []
+    [(name, seconds, labels)] = observed
+    assert name == "http_request_seconds"
+    assert seconds >= 0.05
+    assert labels == {"route": "unmatched", "method": "GET", "status": "200"}
+
+
+def test_event_streams_are_timed_to_headers(monkeypatch):
+    at_headers, observed = timed(monkeypatch, "text/event-stream")
+    assert len(at_headers) == len(observed) == 1
+    assert observed[0][1] < 0.05
@@ -0,0 +1,72 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+server = pytest.importorskip("server")
+
+START = datetime(2026, 1, 1)
+
+
+async def page(collection, limit, after=None, fields=None):
+    response = await server.paginated_response(collection, {}, "timestamp", limit, after, fields)
+    body = "".join([chunk async for chunk in response.body_iterator])
+    return json.loads(body), response.headers.get("x-next-cursor")
+
+
+async def walk(collection, limit, between_pages=None):
+    seen, after = [], None
+    while True:
+        docs, after = await page(collection, limit, after)
+        seen += [doc["id"] for doc in docs]
+        if after is None:
+            return seen
+        if between_pages:
+            await between_pages()
+
+
+def conversation(i, timestamp):
+    return {"id": f"c{i}", "timestamp": timestamp, "message": f"mensagem {i}"}
+
+
+def test_pages_cover_every_row_once_including_timestamp_ties(mongo):
+    async def scenario():
+        # Pairs of rows share a timestamp, so pages split inside a tie
+        await mongo.conversations.insert_many([conversation(i, START + timedelta(seconds=i // 2)) for i in range(9)])
+        return await walk(mongo.conversations, limit=2)
+
+    seen = asyncio.run(scenario())
+    assert sorted(seen) == sorted(f"c{i}" for i in range(9))
+    assert len(seen) == len(set(seen))
+
+
+def test_inserts_between_pages_do_not_skip_rows(mongo):
+    inserted = []
+
+    async def insert_newer():
+        inserted.append(conversation(100 + len(inserted), START + timedelta(days=1, seconds=len(inserted))))
+        await mongo.conversations.insert_one(dict(inserted[-1]))
+
+    async def scenario():
+        await mongo.conversations.insert_many([conversation(i, START + timedelta(seconds=i)) for i in range(5)])
+        return await walk(mongo.conversations, limit=2, between_pages=insert_newer)
+
+    seen = asyncio.run(scenario())
+    assert seen == ["c4", "c3", "c2", "c1", "c0"]
+
+
+def test_last_page_has_no_cursor_and_fields_are_projected(mongo):
+    async def scenario():
+        await mongo.conversations.insert_many([conversation(i, START + timedelta(seconds=i)) for i in range(2)])
+        return await page(mongo.conversations, limit=2, fields="message")
+
+    docs, after = asyncio.run(scenario())
+    assert after is None
+    assert docs[0] == {"id": "c1", "timestamp": "2026-01-01T00:00:01", "message": "mensagem 1"}
+
+
+def test_invalid_cursor_is_rejected(mongo):
+    with pytest.raises(server.HTTPException) as error:
+        asyncio.run(page(mongo.conversations, limit=2, after="não-é-um-cursor"))
+    assert error.value.status_code == 400
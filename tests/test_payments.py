@@ -0,0 +1,115 @@
+import asyncio
+import hashlib
+import hmac
+import time
+
+import pytest
+
+server = pytest.importorskip("server")
+
+
+def sign(payload, secret="whsec_test", timestamp=None):
+    timestamp = str(int(time.time()) if timestamp is None else timestamp)
+    signature = hmac.new(secret.encode(), timestamp.encode() + b"." + payload, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+def test_signature_accepts_valid_header():
+    payload = b'{"id": "evt_1"}'
+    assert server.verify_stripe_signature(payload, sign(payload), "whsec_test")
+
+
+def test_signature_accepts_any_of_several_v1_values():
+    payload = b"{}"
+    header = sign(payload)
+    assert server.verify_stripe_signature(payload, header.replace(",v1=", ",v1=deadbeef,v1="), "whsec_test")
+
+
+@pytest.mark.parametrize("header", ["", "t=abc,v1=00", "v1=00", "t=123"])
+def test_signature_rejects_malformed_header(header):
+    assert not server.verify_stripe_signature(b"{}", header, "whsec_test")
+
+
+def test_signature_rejects_wrong_secret_and_tampered_payload():
+    header = sign(b"{}")
+    assert not server.verify_stripe_signature(b"{}", header, "whsec_other")
+    assert not server.verify_stripe_signature(b"{ }", header, "whsec_test")
+
+
+def test_signature_rejects_stale_timestamp():
+    old = int(time.time()) - server.STRIPE_WEBHOOK_TOLERANCE - 10
+    assert not server.verify_stripe_signature(b"{}", sign(b"{}", timestamp=old), "whsec_test")
+
+
+# apply_checkout_status against an in-memory Mongo
+
+@pytest.fixture
+def db(mongo):
+    async def setup():
+        await mongo.delivery_jobs.create_index("session_id", unique=True)
+        await mongo.products.insert_one({"id": "p1", "name": "Netflix", "price": 30.0, "stock": 4, "active": True})
+
+    asyncio.run(setup())
+    return mongo
+
+
+def transaction(status="held", payment_status="pending"):
+    return server.PaymentTransaction(
+        session_id="cs_1",
+        product_id="p1",
+        discord_user_id="42",
+        amount=30.0,
+        payment_status=payment_status,
+        reservation={"quantity": 1, "status": status},
+    ).dict()
+
+
+def run(db, document, *updates):
+    async def scenario():
+        await db.payment_transactions.insert_one(dict(document))
+        for stripe_status, payment_status in updates:
+            await server.apply_checkout_status(document, stripe_status, payment_status)
+        stored = await db.payment_transactions.find_one({"session_id": "cs_1"})
+        product = await db.products.find_one({"id": "p1"})
+        jobs = await db.delivery_jobs.count_documents({"session_id": "cs_1"})
+        return stored, product["stock"], jobs
+
+    return asyncio.run(scenario())
+
+
+def test_paid_commits_held_reservation_and_queues_delivery_once(db):
+    stored, stock, jobs = run(db, transaction(), ("complete", "paid"), ("complete", "paid"))
+    assert stored["payment_status"] == "paid"
+    assert stored["reservation"]["status"] == "committed"
+    assert stock == 4  # taken when the reservation was made
+    assert jobs == 1
+
+
+def test_paid_after_release_takes_stock(db):
+    stored, stock, jobs = run(db, transaction(status="released"), ("complete", "paid"))
+    assert stored["payment_status"] == "paid"
+    assert stock == 3
+    assert jobs == 1
+
+
+def test_expired_releases_stock_once(db):
+    stored, stock, jobs = run(db, transaction(), ("expired", "unpaid"), ("expired", "unpaid"))
+    assert stored["payment_status"] == "expired"
+    assert stored["reservation"]["status"] == "released"
+    assert stock == 5
+    assert jobs == 0
+
+
+def test_failed_after_paid_is_ignored(db):
+    stored, stock, jobs = run(db, transaction(), ("complete", "paid"), ("complete", "failed"))
+    assert stored["payment_status"] == "paid"
+    assert stock == 4
+    assert jobs == 1
+
+
+def test_open_session_only_updates_stripe_status(db):
+    stored, stock, jobs = run(db, transaction(), ("open", "unpaid"))
+    assert stored["payment_status"] == "pending"
+    assert stored["stripe_status"] == "open"
+    assert jobs == 0
+
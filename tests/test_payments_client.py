@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+
+server = pytest.importorskip("server")
+
+
+class FakeCheckout:
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    async def get_checkout_status(self, session_id):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+def payments_client(*outcomes):
+    client = server.PaymentsClient(timeout=1, retries=0, breaker_threshold=2, breaker_cooldown=30)
+    client._checkout = FakeCheckout(*outcomes)
+    return client
+
+
+def call(client):
+    return asyncio.run(client.get_checkout_status("cs_1"))
+
+
+def test_breaker_opens_after_consecutive_transient_failures():
+    client = payments_client(ConnectionError(), ConnectionError())
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            call(client)
+    assert client.state() == "open"
+    with pytest.raises(server.PaymentsUnavailable):
+        call(client)
+    assert client._checkout.calls == 2
+
+
+def test_non_transient_errors_do_not_trip_the_breaker():
+    client = payments_client(ValueError(), ValueError())
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            call(client)
+    assert client.state() == "closed"
+
+
+def test_successful_half_open_trial_closes_the_breaker():
+    client = payments_client(ConnectionError(), ConnectionError(), "ok")
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            call(client)
+    client.opened_at -= client.breaker_cooldown
+    assert client.state() == "half-open"
+    assert call(client) == "ok"
+    assert client.state() == "closed"
+    assert client.failures == 0
+
+
+def test_failed_half_open_trial_reopens_the_breaker():
+    client = payments_client(ConnectionError(), ConnectionError(), ConnectionError())
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            call(client)
+    client.opened_at -= client.breaker_cooldown
+    with pytest.raises(ConnectionError):
+        call(client)
+    assert client.state() == "open"
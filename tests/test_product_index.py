@@ -0,0 +1,81 @@
+import pytest
+
+server = pytest.importorskip("server")
+
+
+def product(product_id, name, category="streaming", description="", price=10.0, stock=1):
+    return {
+        "id": product_id,
+        "name": name,
+        "category": category,
+        "description": description,
+        "price": price,
+        "stock": stock,
+    }
+
+
+@pytest.fixture
+def index():
+    index = server.ProductIndex()
+    index.sync([
+        product("1", "Netflix Premium", description="Conta 4 telas", price=25.9),
+        product("2", "Spotify Família", category="Música", description="Conta familiar", price=19.9),
+        product("3", "Gift card Steam", category="Jogos", description="Crédito para jogos", price=50.0),
+    ])
+    return index
+
+
+def test_empty_index_returns_no_results():
+    index = server.ProductIndex()
+    assert index.search("netflix", 5) == []
+    assert index.query("netflix") == (0, [], {})
+
+    index.sync([])
+    assert index.query("netflix") == (0, [], {})
+    assert index.query("") == (0, [], {})
+
+
+def test_search_ranks_matching_products(index):
+    results = index.search("quanto custa a netflix?", 5)
+    assert [p["id"] for p in results] == ["1"]
+
+
+def test_query_matches_last_word_as_prefix_and_ignores_accents(index):
+    total, results, _ = index.query("netf")
+    assert total == 1 and results[0]["id"] == "1"
+
+    total, results, _ = index.query("familia")
+    assert total == 1 and results[0]["id"] == "2"
+
+
+def test_query_requires_every_term(index):
+    assert index.query("conta spotify")[0] == 1
+    assert index.query("conta steam")[0] == 0
+
+
+def test_query_filters_and_facets(index):
+    total, results, facets = index.query("conta", category="musica")
+    assert total == 1 and results[0]["id"] == "2"
+    # Facets ignore the category filter itself
+    assert facets == {"streaming": 1, "Música": 1}
+
+    total, results, _ = index.query("", max_price=20)
+    assert total == 1 and results[0]["id"] == "2"
+
+
+def test_browse_orders_by_name_and_counts_categories(index):
+    total, results, facets = index.query("", limit=2)
+    assert total == 3
+    assert [p["name"] for p in results] == ["Gift card Steam", "Netflix Premium"]
+    assert sum(facets.values()) == 3
+
+
+def test_sync_removes_and_reindexes_changed_products(index):
+    index.sync([
+        product("1", "Netflix Básico", description="Conta 1 tela"),
+        product("3", "Gift card Steam", category="Jogos"),
+    ])
+    assert index.query("premium")[0] == 0
+    assert index.query("basico")[0] == 1
+    assert index.query("spotify")[0] == 0
+    assert "Música" not in index.query("")[2]
@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+
+from fakes import FakeChannel, FakeMessage
+
+server = pytest.importorskip("server")
+
+
+def limits(user_burst=2, channel_burst=10, per_minute=60):
+    return [
+        ("user", "user:1", per_minute, user_burst),
+        ("channel", "channel:1", per_minute, channel_burst),
+    ]
+
+
+def acquire(limiter, limit):
+    return asyncio.run(limiter.acquire(limit))
+
+
+def test_limiter_rejects_once_burst_is_spent(clock):
+    limiter = server.TokenBucketLimiter("memory", max_keys=100, notice_interval=30)
+    assert acquire(limiter, limits()) is None
+    assert acquire(limiter, limits()) is None
+    assert acquire(limiter, limits()) == "user"
+
+
+def test_limiter_refills_over_time(clock):
+    limiter = server.TokenBucketLimiter("memory", max_keys=100, notice_interval=30)
+    for _ in range(2):
+        acquire(limiter, limits())
+    clock.now += 1  # 60 per minute: one token back
+    assert acquire(limiter, limits()) is None
+    assert acquire(limiter, limits()) == "user"
+
+
+def test_limiter_charges_no_bucket_when_one_rejects(clock):
+    limiter = server.TokenBucketLimiter("memory", max_keys=100, notice_interval=30)
+    for _ in range(3):
+        acquire(limiter, limits(channel_burst=1))
+    assert limiter.buckets["user:1"][0] == pytest.approx(1)
+
+
+def test_limiter_ignores_disabled_limits(clock):
+    limiter = server.TokenBucketLimiter("memory", max_keys=100, notice_interval=30)
+    for _ in range(5):
+        assert acquire(limiter, limits(per_minute=0)) is None
+
+
+def test_limiter_throttles_notices(clock):
+    limiter = server.TokenBucketLimiter("memory", max_keys=100, notice_interval=30)
+    assert limiter.should_notify("1:1")
+    assert not limiter.should_notify("1:1")
+    clock.now += 31
+    assert limiter.should_notify("1:1")
+
+
+# on_message: AI channel messages are charged, commands never are
+
+@pytest.fixture
+def channel_messages(monkeypatch, clock):
+    channel = FakeChannel()
+    config = {"ai_enabled": True, "ai_channel_id": str(channel.id), "user_rate_limit": 60, "user_rate_burst": 1}
+    answered, commands = [], []
+
+    async def get_bot_config(guild_id):
+        return config
+
+    async def process_ai_message(message):
+        answered.append(message.content)
+
+    async def process_commands(message):
+        commands.append(message.content)
+
+    monkeypatch.setattr(server, "get_bot_config", get_bot_config)
+    monkeypatch.setattr(server, "process_ai_message", process_ai_message)
+    monkeypatch.setattr(server.bot, "process_commands", process_commands)
+    monkeypatch.setattr(server, "rate_limiter", server.TokenBucketLimiter("memory", max_keys=100, notice_interval=30))
+
+    def send(*contents):
+        async def scenario():
+            for content in contents:
+                await server.on_message(FakeMessage(content, channel=channel))
+
+        asyncio.run(scenario())
+        return answered, commands, channel.sent
+
+    return send
+
+
+def test_guild_override_throttles_ai_messages_with_one_notice(channel_messages):
+    answered, _, notices = channel_messages("oi", "tem netflix?", "e spotify?")
+    assert answered == ["oi"]
+    assert len(notices) == 1
+
+
+def test_commands_bypass_the_limiter(channel_messages):
+    answered, commands, notices = channel_messages("oi", "!produtos", "!ajuda")
+    assert answered == ["oi"]
+    assert commands == ["oi", "!produtos", "!ajuda"]
+    assert notices == []
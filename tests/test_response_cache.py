@@ -0,0 +1,45 @@
+import pytest
+
+server = pytest.importorskip("server")
+
+
+def test_cache_matches_normalized_question():
+    cache = server.ResponseCache(max_entries=10, ttl=60)
+    cache.put("Quanto custa a Netflix?", "R$ 30")
+    assert cache.get("quanto custa a netflix") == "R$ 30"
+    assert cache.stats()["hits"] == 1
+
+
+def test_cache_entries_are_scoped():
+    cache = server.ResponseCache(max_entries=10, ttl=60, similarity_threshold=0.5)
+    cache.put("qual o horario de entrega", "Até 18h", scope="guild-1")
+    assert cache.get("qual o horario de entrega", scope="guild-2") is None
+    assert cache.get("qual o horario da entrega", scope="guild-2") is None
+    assert cache.get("qual o horario de entrega", scope="guild-1") == "Até 18h"
+
+
+def test_cache_expires_entries(clock):
+    cache = server.ResponseCache(max_entries=10, ttl=60)
+    cache.put("oi", "Olá!")
+    clock.now += 61
+    assert cache.get("oi") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_cache_evicts_least_recently_used():
+    cache = server.ResponseCache(max_entries=2, ttl=60)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    cache.get("a")
+    cache.put("c", "3")
+    assert cache.get("b") is None
+    assert cache.get("a") == "1"
+    assert cache.get("c") == "3"
+
+
+def test_cache_similarity_fallback():
+    cache = server.ResponseCache(max_entries=10, ttl=60, similarity_threshold=0.5)
+    cache.put("qual o preco do spotify premium", "R$ 20")
+    assert cache.get("preco do spotify premium") == "R$ 20"
+    assert cache.get("como cancelar minha assinatura") is None
+    assert cache.stats()["similar_hits"] == 1
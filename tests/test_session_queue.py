@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+
+from fakes import FakeChannel, FakeMessage
+
+server = pytest.importorskip("server")
+
+
+@pytest.fixture
+def turns(monkeypatch):
+    """Record the batches handed to handle_ai_turn; the first turn waits for release"""
+    monkeypatch.setattr(server, "ai_session_queues", {})
+    monkeypatch.setattr(server, "AI_SESSION_WORKER_IDLE", 0.05)
+    monkeypatch.setattr(server, "AI_COALESCE_WINDOW", 0)
+    batches = []
+    release = {}
+
+    async def handle(messages):
+        batches.append([message.content for message in messages])
+        if len(batches) == 1:
+            await release["first"].wait()
+        if any(message.content == "falha" for message in messages):
+            raise RuntimeError("falha no turno")
+
+    monkeypatch.setattr(server, "handle_ai_turn", handle)
+
+    def start():
+        release["first"] = asyncio.Event()
+        return release["first"]
+
+    return batches, start
+
+
+def test_messages_queued_during_a_turn_are_answered_together(turns):
+    batches, start = turns
+    channel = FakeChannel()
+
+    async def scenario():
+        release = start()
+        await server.process_ai_message(FakeMessage("oi", channel=channel))
+        await asyncio.sleep(0.01)  # the worker takes "oi" and starts its turn
+        await server.process_ai_message(FakeMessage("tudo bem?", channel=channel))
+        await server.process_ai_message(FakeMessage("quero um produto", channel=channel))
+        release.set()
+        await asyncio.sleep(0.01)
+
+    asyncio.run(scenario())
+    assert batches == [["oi"], ["tudo bem?", "quero um produto"]]
+
+
+def test_sessions_are_queued_separately(turns):
+    batches, start = turns
+
+    async def scenario():
+        start().set()
+        channel = FakeChannel()
+        await server.process_ai_message(FakeMessage("a", user_id=1, channel=channel))
+        await server.process_ai_message(FakeMessage("b", user_id=2, channel=channel))
+        await asyncio.sleep(0.01)
+
+    asyncio.run(scenario())
+    assert sorted(batches) == [["a"], ["b"]]
+
+
+def test_worker_exits_when_idle_and_frees_its_queue(turns):
+    batches, start = turns
+
+    async def scenario():
+        start().set()
+        await server.process_ai_message(FakeMessage("oi"))
+        assert len(server.ai_session_queues) == 1
+        await asyncio.sleep(0.1)
+        return len(server.ai_session_queues)
+
+    assert asyncio.run(scenario()) == 0
+
+
+def test_failed_turn_does_not_strand_the_session(turns):
+    batches, start = turns
+    channel = FakeChannel()
+
+    async def scenario():
+        start().set()
+        await server.process_ai_message(FakeMessage("falha", channel=channel))
+        await asyncio.sleep(0.01)
+        await server.process_ai_message(FakeMessage("de novo", channel=channel))
+        await asyncio.sleep(0.01)
+
+    asyncio.run(scenario())
+    assert batches == [["falha"], ["de novo"]]
+
+
+def test_turn_error_survives_a_rejected_error_notice(monkeypatch):
+    async def broken_context(session_id):
+        raise RuntimeError("mongo indisponível")
+
+    monkeypatch.setattr(server, "get_chat_context", broken_context)
+    message = FakeMessage("uma pergunta qualquer", channel=FakeChannel(fail_sends=True))
+    asyncio.run(server.handle_ai_turn([message]))